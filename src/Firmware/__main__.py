@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+from datetime import datetime
 from typing import Tuple
 import sys, atexit, argparse
 
@@ -7,11 +8,65 @@ def init_argparse() -> Tuple[argparse.ArgumentParser, argparse.Namespace]:
 	parser = argparse.ArgumentParser(prog = "homesec", description = "HomeSec Security System", allow_abbrev = False)
 	parser.add_argument("--install", nargs = 1, type = str, help = "Causes HomeSec to be installed on the device", metavar = "type")
 	parser.add_argument("--force", action = "store_true", help = "Forces actions that prompt for force to be used")
-	parser.add_argument("--logs", nargs = "*", type = int, help = "Displays the last 50 log entries and exits", metavar = "count")
+	parser.add_argument("--logs", nargs = "*", type = int, help = "Displays the last 50 log entries, or those matching --type, --since, --until and --grep, and exits", metavar = "count")
+	parser.add_argument("--type", type = str.lower, choices = ("info", "install", "warn", "error", "debug", "exit", "safe"), help = "Only displays logs of this type", metavar = "logtype", dest = "logtype")
+	parser.add_argument("--since", type = datetime.fromisoformat, help = "Only displays logs from this time onwards (YYYY-MM-DD[ HH:MM[:SS]])", metavar = "time")
+	parser.add_argument("--until", type = datetime.fromisoformat, help = "Only displays logs up to this time (YYYY-MM-DD[ HH:MM[:SS]])", metavar = "time")
+	parser.add_argument("--grep", type = str, help = "Only displays logs containing this text", metavar = "text")
+	parser.add_argument("--convert-logs", action = "store_true", help = "Archives a log kept from before logs were archived, converts the active log to the binary log format and uses it from then on")
+	parser.add_argument("--migrate-sessions", action = "store_true", help = "Moves session files into the sharded session store, copies them into the configured session backend and exits")
 	parser.add_argument("--aided", action="store_true", help = "Acts as a guided install")
 	return (parser, parser.parse_args(sys.argv[1:]))
 
 def main():
+	parser, options = init_argparse()
+
+	if isinstance(options.logs, list):
+		import logger
+		if len(options.logs) != 1: options.logs = [50]
+
+		# Read straight from the log files, the logger and its threads aren't needed
+		if options.logtype is None and options.since is None and options.until is None and options.grep is None:
+			logs = logger.Logger.tail(options.logs[0])
+		else:
+			logs = logger.Logger.query(options.logtype, None if options.since is None else int(options.since.timestamp()), \
+				None if options.until is None else int(options.until.timestamp()), options.grep, options.logs[0])
+
+		for log in logs:
+			print(log)
+
+		return
+
+	if options.convert_logs:
+		import logger
+		archived = logger.Logger.get_logger().archive_legacy()
+		if archived:
+			print(f"Archived {archived} log entries from before logs were archived")
+
+		try:
+			print(f"Converted {logger.Logger.convert_to_binary()} log entries to the binary log format")
+		except (FileNotFoundError, FileExistsError) as e:
+			print("Cannot convert logs:", e)
+
+		return
+
+	if options.migrate_sessions:
+		import io_handles
+		from networking import sessions
+		folder_path = io_handles.FileUtil.root() + "/data/sessions/"
+
+		file_store = sessions.FileSessionStore(folder_path) # Migrates while indexing
+		print(f"Moved {file_store.migrated} session files, {len(file_store.index)} session files are stored")
+
+		store = sessions.SessionStore.from_config(folder_path)
+		if not isinstance(store, sessions.FileSessionStore):
+			session_data = file_store.load_all()
+			store.save_many([(sessions.Session.from_data(id, data), False) for id, data in session_data.items()])
+			store.close()
+			print(f"Copied {len(session_data)} sessions into the {type(store).__name__}")
+
+		return
+
 	import logger
 	from networking import sessions
 
@@ -19,8 +74,6 @@ def main():
 	atexit.register(sessions.SessionManager.get_manager().shutdown)
 	atexit.register(logger.Logger.get_logger().finalize)
 
-	parser, options = init_argparse()
-
 	if options.install and isinstance(options.install, list) and len(options.install) == 1:
 		import installer
 		install_type = options.install[0].lower()
@@ -29,15 +82,6 @@ def main():
 
 		installer.main(install_type, options.force)
 
-	elif isinstance(options.logs, list):
-		import logger
-		if len(options.logs) != 1: options.logs = [50]
-
-		logs = logger.Logger.get_logger().get(options.logs[0])
-
-		for log in logs:
-			logger.Logger.get_logger().print(log)
-
 	elif options.aided:
 		choice = ""
 		while choice not in ("server", "client"):
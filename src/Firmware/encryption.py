@@ -4,7 +4,11 @@ from Crypto.Signature import pkcs1_15
 from Crypto.Cipher._mode_eax import EaxMode
 from Crypto.PublicKey import RSA
 from Crypto.Hash import SHA3_512
-from typing import Tuple, Union
+from hashlib import sha256, sha3_256
+from threading import Event, RLock, get_native_id
+from time import time
+from typing import Dict, List, Tuple, Union
+import atexit, hmac, os
 
 class EasyAES:
 
@@ -62,3 +66,292 @@ class EasyRSA:
 			return False
 		else:
 			return True
+
+class EasyMAC:
+
+	SIGNING_CONTEXT = b"HomeSec packet signing v1"
+
+	def __init__(self, key: bytes):
+		if not isinstance(key, bytes) or len(key) != 32:
+			raise ValueError("MAC key length isn't 32 bytes")
+
+		self.key = key # 32 bytes
+
+	@staticmethod
+	def from_shared_aes(shared_aes: bytes, sender: str) -> "EasyMAC":
+		"""
+		Derives the signing key for packets sent by sender ("server" or
+		"client") from the shared AES key agreed on during KEv1/SKEv1 so
+		the AES key itself is never used for two purposes and a packet
+		can't be reflected back to the device that sent it
+		"""
+		if not isinstance(shared_aes, bytes) or len(shared_aes) != 32:
+			raise ValueError("AES key length isn't 32 bytes")
+
+		if sender not in ("server", "client"):
+			raise ValueError("Invalid Sender")
+
+		return EasyMAC(hmac.new(shared_aes, EasyMAC.SIGNING_CONTEXT + b" " + sender.encode(), sha3_256).digest())
+
+	def sign(self, data: bytes) -> bytes:
+		return hmac.new(self.key, data, sha3_256).digest() # 32 bytes
+
+	def verify(self, data: bytes, signature: bytes) -> bool:
+		return hmac.compare_digest(self.sign(data), bytes(signature))
+
+class RSAKeyCache:
+	"""
+	Parsed EasyRSA objects for session keys, keyed by session id and
+	the fingerprint of the DER they were imported from so packets on
+	the same session don't have to import the key again
+
+	Entries are dropped when their session is destroyed or has expired
+	"""
+
+	__instance = None
+
+	@classmethod
+	def get_cache(cls) -> "RSAKeyCache":
+		if cls.__instance is None:
+			cls.__instance = cls.__new__(cls)
+			self = cls.__instance
+
+			self.keys = {}
+			self.expires = {}
+			self.lock = RLock()
+
+		return cls.__instance
+
+	def __init__(self):
+		# For typing
+		self.keys: Dict[bytes, Dict[bytes, EasyRSA]]
+		self.expires: Dict[bytes, int]
+		self.lock: RLock
+
+		raise RuntimeError("Get RSA key cache from RSAKeyCache.get_cache()")
+
+	def get(self, session_id: bytes, key: bytes, expires: int = None) -> EasyRSA:
+		"""
+		Gets the EasyRSA object for a key belonging to a session,
+		importing it only if it hasn't been seen for that session
+		"""
+		fingerprint = sha256(key).digest()
+
+		with self.lock:
+			session_keys = self.keys.get(session_id)
+
+			if session_keys is not None:
+				rsa = session_keys.get(fingerprint)
+				if rsa is not None:
+					return rsa
+
+			self.evict_expired()
+			rsa = EasyRSA(key)
+
+			if session_keys is None:
+				session_keys = self.keys[session_id] = {}
+
+			session_keys[fingerprint] = rsa
+
+			if expires is not None:
+				self.expires[session_id] = expires
+
+			return rsa
+
+	def evict(self, session_id: bytes) -> None:
+		with self.lock:
+			self.keys.pop(session_id, None)
+			self.expires.pop(session_id, None)
+
+	def evict_expired(self) -> None:
+		with self.lock:
+			now = int(time())
+
+			for session_id in [session_id for session_id, expires in self.expires.items() if now >= expires]:
+				self.evict(session_id)
+
+	def clear(self) -> None:
+		with self.lock:
+			self.keys = {}
+			self.expires = {}
+
+class KeyPool:
+	"""
+	RSA-4096 keypairs generated ahead of time so handshakes don't wait
+	seconds on RSA.generate
+
+	A low priority background thread keeps the pool topped up to its size
+	and saves the spare keys to data/keypool.homesec so they survive
+	restarts. Keys taken from the pool are removed from the file by the
+	background thread, not on the handshake that took them. The pool size
+	is read from the keypool_size config value.
+
+	The pool isn't started until a key is first taken, which also
+	registers finalize to run at exit.
+
+	Saved keys are only obfuscated, not protected: they are encrypted with
+	a hash of the installation uuid, which is stored in plain text in
+	data/config.homesec, so anyone who can read the config can read the
+	keys. The file is kept private by its permissions alone (0600, in a
+	0700 folder)
+	"""
+
+	DEFAULT_SIZE = 4
+
+	__instance = None
+
+	@classmethod
+	def get_pool(cls, size: int = None) -> "KeyPool":
+		if cls.__instance is None:
+			cls.__instance = cls.__new__(cls)
+			self = cls.__instance
+
+			self.__dead = False
+
+			self.size = installer.get_config_int("keypool_size", KeyPool.DEFAULT_SIZE, 0) if size is None else size
+			self.lock = RLock()
+			self.pool_file = io_handles.EasyFile(io_handles.FileUtil.root() + "/data/keypool.homesec", True, atomic = True)
+
+			self.__storage_key = EasyAES(sha256(installer.get_installation()[2].encode("utf-8")).digest())
+			self.__wanted = Event()
+			self.__lowered_priority = False
+			self.__unsaved = False
+			self.__save_lock = RLock()
+
+			self.keys = self.__load()
+
+			self.__refill_thread = thread.EasyThread(self.__refill, True)
+			self.__refill_thread.start()
+
+			atexit.register(self.finalize)
+
+		if cls.__instance.__dead:
+			dead = type("Dead KeyPool", (object,), {})
+			dead.size = dead.lock = dead.pool_file = dead.keys = dead.__dead = None
+			dead.take = lambda *args, **kwargs: EasyRSA()
+			dead.resize = dead.finalize = lambda *args, **kwargs: None
+			return dead
+
+		return cls.__instance
+
+	def __init__(self):
+		# For typing
+		self.size: int
+		self.lock: RLock
+		self.pool_file: io_handles.EasyFile
+		self.keys: List[EasyRSA]
+
+		self.__dead: bool
+		self.__storage_key: EasyAES
+		self.__wanted: Event
+		self.__lowered_priority: bool
+		self.__unsaved: bool # Keys have been taken since the last save
+		self.__save_lock: RLock
+		self.__refill_thread: thread.EasyThread
+
+		raise RuntimeError("Get key pool from KeyPool.get_pool()")
+
+	def take(self) -> EasyRSA:
+		"""
+		Takes a keypair out of the pool, if the pool is empty one is
+		generated on the calling thread. The refill thread saves the pool
+		"""
+		rsa = None
+
+		with self.lock:
+			if not self.__dead and len(self.keys):
+				rsa = self.keys.pop()
+				self.__unsaved = True
+
+		self.__wanted.set()
+
+		if rsa is None:
+			rsa = EasyRSA()
+
+		return rsa
+
+	def resize(self, size: int) -> None:
+		with self.lock:
+			self.size = size
+
+			shrunk = len(self.keys) > size
+
+			if shrunk:
+				self.keys = self.keys[:size]
+
+		if shrunk:
+			self.__save()
+
+		self.__wanted.set()
+
+	def finalize(self) -> None:
+		with self.lock:
+			if self.__dead: return
+			self.__dead = True
+
+			self.__refill_thread.kill()
+
+		self.__save()
+
+	def __load(self) -> List[EasyRSA]:
+		keys = []
+
+		for key in io_handles.KeyPoolFileFormat().from_file(self.pool_file).keys:
+			try:
+				keys.append(EasyRSA(self.__storage_key.decrypt(key[32:], key[16:32], key[:16])))
+			except ValueError: # Key was saved by a prior install or is corrupt
+				continue
+
+		return keys[:self.size]
+
+	def __save(self) -> None:
+		"""
+		Saves the pool without holding the lock, saves are kept in order
+		by the save lock
+		"""
+		with self.__save_lock:
+			with self.lock:
+				keys = list(self.keys)
+				self.__unsaved = False
+
+			data = io_handles.KeyPoolFileData()
+
+			for rsa in keys:
+				ciphertext, mac_tag, nonce = self.__storage_key.encrypt(rsa.private_key)
+				data.keys.append(nonce + mac_tag + ciphertext)
+
+			io_handles.KeyPoolFileFormat().save_to(self.pool_file, data)
+
+	def __refill(self) -> None:
+		if not self.__lowered_priority:
+			self.__lowered_priority = True
+
+			try: # Per thread niceness is Linux only
+				os.setpriority(os.PRIO_PROCESS, get_native_id(), 19)
+			except (AttributeError, OSError):
+				pass
+
+		if self.__unsaved: # Drop taken keys from the file before spending seconds on a new one
+			self.__save()
+
+		self.__wanted.clear() # Before checking, so a take() after the check still wakes the wait
+
+		with self.lock:
+			full = len(self.keys) >= self.size
+
+		if full:
+			self.__wanted.wait(30)
+			return
+
+		rsa = EasyRSA() # Generated without holding the lock so take() isn't blocked
+
+		with self.lock:
+			added = not self.__dead and len(self.keys) < self.size
+
+			if added:
+				self.keys.append(rsa)
+
+		if added:
+			self.__save()
+
+import io_handles, installer, thread
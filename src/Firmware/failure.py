@@ -78,28 +78,27 @@ def code_within_ranges(code: int) -> bool:
 	return False
 
 def __finalize(code: FailureCode, info: str, log: Optional[bool], trace: Optional[Union[str, BaseException]], trace2: Optional[Union[str, BaseException]], codetype: str):
-	name = code.name.replace("_", " ")
-	if trace:
-		if isinstance(trace, BaseException):
-			trace = "\n".join(traceback.format_exception(type(trace), trace, None))
+	if trace and not isinstance(trace, (str, BaseException)):
+		sys.exit(Failure.Invalid_Trace.value[0])
 
-		if not isinstance(trace, str):
-			sys.exit(Failure.Invalid_Trace.value[0])
+	# Tracebacks are only formatted by the logger's thread, and not at all if codetype isn't logged
+	def message() -> str:
+		name = code.name.replace("_", " ")
+		if not trace:
+			return f"{name}\n{info}" if info else f"{name}"
+
+		full_trace = trace
+		if isinstance(full_trace, BaseException):
+			full_trace = "\n".join(traceback.format_exception(type(full_trace), full_trace, None))
 
 		if isinstance(trace2, BaseException):
-			trace += "\n".join(traceback.format_exception(type(trace2), trace2, None))
+			full_trace += "\n".join(traceback.format_exception(type(trace2), trace2, None))
 		elif isinstance(trace2, str):
-			trace += f"\n{trace2}"
+			full_trace += f"\n{trace2}"
 
-		if info:
-			logger.Log(codetype, f"{name}\n{info}\n{trace}", print = log)
-		else:
-			logger.Log(codetype, f"{name}\n{trace}", print = log)
-	else:
-		if info:
-			logger.Log(codetype, f"{name}\n{info}", print = log)
-		else:
-			logger.Log(codetype, f"{name}", print = log)
+		return f"{name}\n{info}\n{full_trace}" if info else f"{name}\n{full_trace}"
+
+	logger.Log(codetype, message, print = log)
 
 def die(code: FailureCode, info: str, log: Optional[bool] = True, trace: Optional[Union[str, BaseException]] = None, trace2: Optional[Union[str, BaseException]] = None) -> None:
 	if not isinstance(code, FailureCode) or not code_within_ranges(code.value[0]):
@@ -1,17 +1,103 @@
 from typing import BinaryIO, Tuple
+from os import stat
 import subprocess
 
-def get_current_version() -> str: return "0.0.1"
+def get_current_version() -> str: return "0.0.2"
 
 def get_version_string() -> str: return get_installation()[1]
 
-def get_version_tuple() -> Tuple[int, int, int]: return [int(value) for value in get_version_string().split(".")]
+def get_version_tuple() -> Tuple[int, int, int]: return __version_cache(get_config())[0]
 
-def get_version_bytes() -> bytes: return bytes(get_version_tuple())
+def get_version_bytes() -> bytes: return __version_cache(get_config())[1]
+
+def get_config_path() -> str: return io_handles.FileUtil.root() + "/data/config.homesec"
+
+# ((inode, mtime in ns, size) of the config file when it was read, its data)
+__config_cache: Tuple[Tuple[int, int, int], "io_handles.ConfigFileData"] = (None, None)
+
+# (config data the version was read from, version tuple, version bytes)
+__version: Tuple["io_handles.ConfigFileData", Tuple[int, int, int], bytes] = (None, None, None)
+
+def __config_key(path: str) -> Tuple[int, int, int]:
+	try:
+		stats = stat(path)
+	except FileNotFoundError:
+		return None
+
+	return stats.st_ino, stats.st_mtime_ns, stats.st_size
+
+def __version_cache(config_data: "io_handles.ConfigFileData") -> Tuple[Tuple[int, int, int], bytes]:
+	global __version
+
+	if __version[0] is not config_data:
+		version = tuple(int(value) for value in get_installation()[1].split("."))
+		__version = (config_data, version, bytes(version))
+
+	return __version[1], __version[2]
+
+def get_config() -> "io_handles.ConfigFileData":
+	"""
+	Reads the config file, an empty config is returned if there isn't one
+
+	The config is only read again once the file's inode, mtime or size
+	changes, the data returned is shared so change it with set_config_value
+	"""
+	global __config_cache
+
+	key = __config_key(get_config_path())
+	if key is None:
+		__config_cache = (None, None)
+		return io_handles.ConfigFileData()
+
+	if __config_cache[0] != key:
+		__config_cache = (key, io_handles.ConfigFileFormat().from_file(io_handles.EasyFile(get_config_path())))
+
+	return __config_cache[1]
+
+def get_config_value(key: str, default: str = None) -> str:
+	config_data = get_config()
+
+	if key in config_data.data:
+		return config_data.data[key]
+
+	return default
+
+def get_config_int(key: str, default: int, minimum: int = 1) -> int:
+	"""
+	Config values are saved as strings, the default is used if the value
+	isn't an integer of at least minimum
+	"""
+	try:
+		value = int(get_config_value(key, default))
+	except (TypeError, ValueError):
+		return default
+
+	return value if value >= minimum else default
+
+def get_config_float(key: str, default: float, minimum: float = 0) -> float:
+	"""
+	Like get_config_int but for values that can be fractional, the default
+	is used if the value isn't a finite number greater than minimum
+	"""
+	try:
+		value = float(get_config_value(key, default))
+	except (TypeError, ValueError):
+		return default
+
+	return value if minimum < value < float("inf") else default
+
+def set_config_value(key: str, value: str) -> None:
+	global __config_cache
+
+	config_data = io_handles.ConfigFileData()
+	config_data.data.update(get_config().data)
+	config_data.data[key] = value
+
+	io_handles.ConfigFileFormat().save_to(io_handles.EasyFile(get_config_path(), True, atomic = True), config_data)
+	__config_cache = (__config_key(get_config_path()), config_data) # A write within the mtime's resolution could look unchanged
 
 def get_installation() -> Tuple[str, str, str]:
-	config_file = io_handles.EasyFile(io_handles.FileUtil.root() + "/data/config.homesec", True)
-	config_data = io_handles.ConfigFileFormat().from_file(config_file)
+	config_data = get_config()
 
 	if "successful_install" in config_data.data and config_data.successful_install == "True":
 		if "install_type" in config_data.data and "version" in config_data.data and "uuid" in config_data.data:
@@ -168,7 +254,7 @@ Alias=dbus-org.bluez.service""")
 		logger.Log("install", "09 / 10 - Made startup file executable\nTriggering restart after completing installation process successfully", print = True)
 
 
-		config_file = io_handles.EasyFile(config_file_path, True)
+		config_file = io_handles.EasyFile(config_file_path, True, atomic = True)
 		config_data = io_handles.ConfigFileData()
 		config_data.install_type = install_type
 		config_data.version = get_current_version()
@@ -1,8 +1,13 @@
-from os import access, R_OK, W_OK, X_OK, makedirs, open as fdesk, remove
+from os import access, R_OK, W_OK, X_OK, O_RDONLY, makedirs, open as fdesk, close as fdclose, fsync, pread, pwrite, remove, replace
 from os.path import abspath, isfile, isdir, sep, dirname
 from hashlib import sha256
-from typing import AnyStr, BinaryIO, Dict, IO, Callable, List, Any, Type, Tuple, TypeVar, Union
-import inspect, re, pathlib
+from typing import AnyStr, BinaryIO, Dict, IO, Callable, List, Any, NamedTuple, Type, Tuple, TypeVar, Union
+from io import BytesIO
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from threading import RLock, local
+from tempfile import mkstemp
+import inspect, mmap, re, pathlib, zlib, lzma
 
 T = TypeVar("T")
 
@@ -16,6 +21,7 @@ def get_file_access(action: str) -> str:
 		if action in ("override", "overwrite", "write"): return "bw+"
 		elif action == "append": return "ba"
 		elif action == "read": return "br"
+		elif action == "update": return "br+"
 
 def get_file_perms(filepath: str) -> int:
 	"""
@@ -27,11 +33,26 @@ def get_file_perms(filepath: str) -> int:
 class EasyFile:
 	"""
 	A simplified way to work with files
+
+	A file that's written often can be held, get_stream then reuses one
+	open handle until close is called
+
+	Writes to an atomic file go to a temporary file that's synced and
+	renamed over the file, so a crash leaves either the old or the new
+	contents. The directory is synced after the rename, or once for
+	every file saved in a CommitGroup
+
+	get_view maps the file and hands the callback a memoryview of it
 	"""
 
-	def __init__(self, filepath: str, should_create: bool = False, force_extension: bool = True):
+	__callbacks: Dict[Tuple[Any, bool], bool] = {} # (code object, is bound method): callback takes a stream
+
+	def __init__(self, filepath: str, should_create: bool = False, force_extension: bool = True, atomic: bool = False):
 		if force_extension and not filepath.endswith(".homesec"): filepath += ".homesec"
 		self.filepath = abspath(filepath)
+		self.atomic = atomic
+		self.__handle: BinaryIO = None
+		self.__handle_lock = RLock()
 
 		if not self.exists:
 			if should_create:
@@ -71,26 +92,177 @@ class EasyFile:
 
 	def shred(self): return self.delete() # Cooler name
 
+	@property
+	def held(self) -> bool: return self.__handle is not None
+
+	def hold(self) -> None:
+		"""
+		Keeps a handle open for every get_stream call until close
+		"""
+		with self.__handle_lock:
+			if self.__handle is None:
+				self.__handle = open(self.filepath, "br+")
+
+	def close(self) -> None:
+		with self.__handle_lock:
+			if self.__handle is not None:
+				self.__handle.close()
+				self.__handle = None
+
+	@staticmethod
+	def __accepts_stream(callback: Callable) -> bool:
+		"""
+		Checks the callback takes just a stream, the check is cached by code
+		object so callbacks defined inside a function are only inspected once
+		"""
+		code = getattr(getattr(callback, "__func__", callback), "__code__", None)
+		key = (code, inspect.ismethod(callback))
+
+		if code is None or key not in EasyFile.__callbacks:
+			argspec = inspect.getfullargspec(callback)
+			accepts = len(argspec.args) == 1 and (argspec.args[0] not in argspec.annotations or argspec.annotations[argspec.args[0]] in (BinaryIO, IO))
+
+			if code is None:
+				return accepts
+
+			EasyFile.__callbacks[key] = accepts
+
+		return EasyFile.__callbacks[key]
+
 	def get_stream(self, action: str, callback: Callable[[BinaryIO], T]) -> T:
+		# Permissions aren't checked first, open raises PermissionError itself
 		access_action = get_file_access(action)
 
-		if access_action:
-			action = action.lower()
+		if access_action and EasyFile.__accepts_stream(callback):
+			if self.atomic and action.lower() == "write":
+				return self.__atomic_write(callback)
 
-			if action in ("write", "append") and not self.can_write:
-				raise PermissionError(f"Cannot {action} the file")
-			elif action in ("read",) and not self.can_read:
-				raise PermissionError("Cannot read the file")
+			if self.__handle is not None:
+				with self.__handle_lock:
+					if self.__handle is not None:
+						return self.__held_stream(action.lower(), callback)
 
-			argspec = inspect.getfullargspec(callback)
-			if len(argspec.args) == 1:
-				if argspec.args[0] in argspec.annotations:
-					if argspec.annotations[argspec.args[0]] in (BinaryIO, IO):
-						with open(self.filepath, access_action) as file_access:
-							return callback(file_access)
-				else:
-					with open(self.filepath, access_action) as file_access:
-						return callback(file_access)
+			with open(self.filepath, access_action) as file_access:
+				return callback(file_access)
+
+	def get_view(self, callback: Callable[[memoryview], T]) -> T:
+		"""
+		Maps the file read only and calls back with a memoryview of it, an
+		empty file gives an empty memoryview
+
+		The view is released once the callback returns, anything kept from
+		it must be copied out with bytes()
+		"""
+		with self.__handle_lock:
+			if self.__handle is not None:
+				self.__handle.flush()
+				return self.__map(self.__handle.fileno(), callback)
+
+		with open(self.filepath, "br") as file_access:
+			return self.__map(file_access.fileno(), callback)
+
+	@staticmethod
+	def __map(fd: int, callback: Callable[[memoryview], T]) -> T:
+		try:
+			mapped = mmap.mmap(fd, 0, access = mmap.ACCESS_READ)
+		except ValueError: # Empty files can't be mapped
+			return callback(memoryview(b""))
+
+		view = memoryview(mapped)
+		try:
+			return callback(view)
+		finally:
+			view.release()
+
+			try:
+				mapped.close()
+			except BufferError:
+				pass # A slice of the view is still alive, the map is closed once it's collected
+
+	def __atomic_write(self, callback: Callable[[BinaryIO], T]) -> T:
+		fd, temp_path = mkstemp(".tmp", f".{self.name}.", self.parent_directory)
+
+		try:
+			with open(fd, "bw") as stream:
+				result = callback(stream)
+				stream.flush()
+				fsync(stream.fileno())
+
+			with self.__handle_lock:
+				held = self.__handle is not None
+				self.close() # The handle would keep pointing at the replaced file
+
+				replace(temp_path, self.filepath)
+
+				if held:
+					self.hold()
+
+		except BaseException:
+			FileUtil.delete_file(temp_path)
+			raise
+
+		group = CommitGroup.current()
+		if group is None:
+			FileUtil.sync_directory(self.parent_directory)
+		else:
+			group.directories.add(self.parent_directory)
+
+		return result
+
+	def __held_stream(self, action: str, callback: Callable[[BinaryIO], T]) -> T:
+		handle = self.__handle
+		handle.flush() # Also drops read ahead data that could be stale
+		handle.seek(0, 2 if action == "append" else 0)
+
+		if action == "write":
+			handle.truncate()
+
+		try:
+			return callback(handle)
+		finally:
+			handle.flush()
+
+class CommitGroup:
+	"""
+	Shares directory syncs between atomic saves
+
+	While a group is open on a thread the atomic files it saves only sync
+	themselves, every directory they were renamed into is synced once
+	when the group closes. Nested groups commit with the outermost one
+
+		with CommitGroup():
+			for session in dirty:
+				session.save()
+	"""
+
+	__local = local()
+
+	def __init__(self):
+		self.directories = set()
+
+	@staticmethod
+	def current() -> Union["CommitGroup", None]:
+		groups = getattr(CommitGroup.__local, "groups", None)
+		return groups[-1] if groups else None
+
+	def __enter__(self) -> "CommitGroup":
+		if not hasattr(CommitGroup.__local, "groups"):
+			CommitGroup.__local.groups = []
+
+		CommitGroup.__local.groups.append(self)
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		CommitGroup.__local.groups.pop()
+
+		outer = CommitGroup.current()
+		if outer is not None:
+			outer.directories.update(self.directories)
+		else:
+			for directory in self.directories:
+				FileUtil.sync_directory(directory)
+
+		self.directories = set()
 
 class FileDecodeError(Exception): pass
 
@@ -172,32 +344,90 @@ class LogFileFormat(EasyFileFormat, data = LogFileData):
 	Log file format
 	"""
 
-	def from_file(self, file: EasyFile) -> LogFileData:
+	def parse_line(self, line: bytes) -> Union["logger.LogData", None]:
+		"""
+		Decodes a single log line, None is returned if the line isn't a
+		valid log entry
+		"""
+		line = line.rstrip(b"\n").decode("utf-8")
+
+		match: re.Match[AnyStr] = re.match(r"\d{2}/\d{2}/\d{4} :: \d{2}:\d{2}:\d{2} \[\w+\]", line)
+		if match:
+			date = re.search(r"\d{2}/\d{2}/\d{4}", line).group(0)
+			time = re.search(r"\d{2}:\d{2}:\d{2}", line).group(0)
+			logtype = re.search(r"\[\w+\]", line).group(0)[1:-1]
+			info = line[match.end(0) + 1:].encode("utf-8").decode("unicode_escape")
+
+			if not logger.LogTypes.is_valid_type(logtype):
+				logtype = logger.LogTypes.Info
+
+			return logger.LogData(logtype, info, repr(info)[1:-1], logger.TimestampData(date, time))
+
+	def from_bytes(self, buffer: bytes) -> LogFileData:
 		data = LogFileData()
 
+		for line_num, line in enumerate(buffer.splitlines(), 1):
+			logdata = self.parse_line(line)
+			if logdata is None:
+				raise FileDecodeError(f"One or more log entries were invalid (First line fail: {line_num})")
+
+			data.add_log(logdata)
+
+		return data
+
+	def from_file(self, file: EasyFile) -> LogFileData:
+		def read(stream: BinaryIO):
+			return stream.read()
+
+		return self.from_bytes(file.get_stream("read", read))
+
+	def tail(self, file: EasyFile, count: int, block_size: int = 8192) -> List["logger.LogData"]:
+		"""
+		Reads only the last count entries by seeking backwards from the
+		end of the file a block at a time
+
+		Escaped newlines in messages never split an entry. Lines that don't
+		start with a timestamp are joined onto the entry before them.
+		"""
+		logs: List[logger.LogData] = []
+
 		def read(stream: BinaryIO):
-			line_num = 1
-			for line in stream.readlines(): # May change to enumerate
-				line = line.rstrip(b"\n").decode("utf-8")
-
-				match: re.Match[AnyStr] = re.match(r"\d{2}/\d{2}/\d{4} :: \d{2}:\d{2}:\d{2} \[\w+\]", line)
-				if match:
-					date = re.search(r"\d{2}/\d{2}/\d{4}", line).group(0)
-					time = re.search(r"\d{2}:\d{2}:\d{2}", line).group(0)
-					logtype = re.search(r"\[\w+\]", line).group(0)[1:-1]
-					info = line[match.end(0) + 1:].encode("utf-8").decode("unicode_escape")
-
-					logdata: logger.LogData = logger.Log(logtype, info, False, False)
-					logdata.timestamp.date = date
-					logdata.timestamp.time = time
-					data.add_log(logdata)
-
-					line_num += 1
+			position = stream.seek(0, 2)
+			partial = b"" # Start of the earliest line read, may continue into the previous block
+			continuation: List[bytes] = []
+
+			while len(logs) < count and (position > 0 or len(partial)):
+				if position > 0:
+					read_size = min(block_size, position)
+					position -= read_size
+					stream.seek(position)
+					lines = (stream.read(read_size) + partial).split(b"\n")
+					partial = lines.pop(0) # Could be cut off by the block boundary
+
 				else:
-					raise FileDecodeError(f"One or more log entries were invalid (First line fail: {line_num})")
+					lines = [partial]
+					partial = b""
 
-		file.get_stream("read", read)
-		return data
+				for line in reversed(lines):
+					if not len(line):
+						continue
+
+					logdata = self.parse_line(b"\n".join([line] + continuation))
+					if logdata is None:
+						continuation.insert(0, line)
+						continue
+
+					continuation = []
+					logs.append(logdata) # Newest first until reversed
+
+					if len(logs) >= count:
+						break
+
+		if count > 0:
+			file.get_stream("read", read)
+
+		logs.reverse()
+		return logs
 
 	def save_to(self, file: EasyFile, data: LogFileData) -> bool:
 		def write(stream: BinaryIO):
@@ -207,6 +437,360 @@ class LogFileFormat(EasyFileFormat, data = LogFileData):
 		file.get_stream("write", write)
 		return True
 
+	def iter_logs(self, stream: BinaryIO):
+		"""
+		Decodes entries a line at a time from the stream's position, lines
+		that aren't entries are skipped
+		"""
+		for line in stream:
+			logdata = self.parse_line(line)
+			if logdata is not None:
+				yield logdata
+
+	def encode(self, log: "logger.LogData") -> bytes:
+		return f"{log!r}\n".encode("utf-8")
+
+	def append_to(self, file: EasyFile, logs: List["logger.LogData"], sync: bool = False) -> List[int]:
+		"""
+		Appends log entries to the end of the file with a single write,
+		the lines written are the same as save_to would write
+
+		Returns the offset each entry was written at
+		"""
+		return append_encoded(file, [self.encode(log) for log in logs], sync)
+
+class BinaryLogFileFormat(EasyFileFormat, data = LogFileData):
+	"""
+	Binary log file format
+
+	Each record is the message length (4), epoch seconds (8), the log
+	type's byte (1), the UTF-8 message and the message length again (4)
+	so the file can be read from either end
+	"""
+
+	def encode(self, log: "logger.LogData") -> bytes:
+		message = log.unsafe_message.encode("utf-8")
+		type_id = logger.LogTypes.type_ids.get(log.logtype.lower(), 0)
+
+		return codec.LOG_RECORD_HEADER.pack(len(message), log.timestamp.epoch, type_id) + message + codec.UINT32.pack(len(message))
+
+	def decode(self, header: bytes, message: bytes) -> "logger.LogData":
+		_, epoch, type_id = codec.LOG_RECORD_HEADER.unpack(header)
+		logtype = logger.LogTypes.types[type_id] if type_id < len(logger.LogTypes.types) else logger.LogTypes.Info
+
+		try:
+			message = message.decode("utf-8")
+		except UnicodeDecodeError:
+			raise FileDecodeError("Invalid character, cannot decode log entry")
+
+		return logger.LogData(logtype, message, repr(message)[1:-1], logger.Timestamp.from_epoch(epoch))
+
+	def iter_logs(self, stream: BinaryIO):
+		"""
+		Decodes entries one at a time from a stream
+		"""
+		header_size = codec.LOG_RECORD_HEADER.size
+
+		while True:
+			header = stream.read(header_size)
+			if len(header) != header_size:
+				if not len(header): # EOF at the right time
+					return
+
+				raise FileDecodeError("EOF reached at an invalid point in binary log file (1)")
+
+			message_length = codec.LOG_RECORD_HEADER.unpack(header)[0]
+			message = stream.read(message_length)
+			footer = stream.read(4)
+
+			if len(message) != message_length or len(footer) != 4:
+				raise FileDecodeError("EOF reached at an invalid point in binary log file (2)")
+
+			if codec.UINT32.unpack(footer)[0] != message_length:
+				raise FileDecodeError("Binary log entry's length markers don't match")
+
+			yield self.decode(header, message)
+
+	def from_bytes(self, buffer: bytes) -> LogFileData:
+		data = LogFileData()
+
+		for log in self.iter_logs(BytesIO(buffer)):
+			data.add_log(log)
+
+		return data
+
+	def from_file(self, file: EasyFile) -> LogFileData:
+		data = LogFileData()
+
+		def read(stream: BinaryIO):
+			for log in self.iter_logs(stream):
+				data.add_log(log)
+
+		file.get_stream("read", read)
+		return data
+
+	def save_to(self, file: EasyFile, data: LogFileData) -> bool:
+		def write(stream: BinaryIO):
+			stream.write(b"".join([self.encode(log) for log in data.logs]))
+
+		file.get_stream("write", write)
+		return True
+
+	def append_to(self, file: EasyFile, logs: List["logger.LogData"], sync: bool = False) -> List[int]:
+		return append_encoded(file, [self.encode(log) for log in logs], sync)
+
+	def tail(self, file: EasyFile, count: int) -> List["logger.LogData"]:
+		"""
+		Reads only the last count entries by following the trailing
+		length of each record backwards from the end of the file
+		"""
+		logs: List[logger.LogData] = []
+		header_size = codec.LOG_RECORD_HEADER.size
+
+		def read(stream: BinaryIO):
+			position = stream.seek(0, 2)
+
+			while len(logs) < count and position > 0:
+				if position < header_size + 4:
+					raise FileDecodeError("EOF reached at an invalid point in binary log file (3)")
+
+				stream.seek(position - 4)
+				message_length = codec.UINT32.unpack(stream.read(4))[0]
+				position -= header_size + message_length + 4
+
+				if position < 0:
+					raise FileDecodeError("EOF reached at an invalid point in binary log file (4)")
+
+				stream.seek(position)
+				record = stream.read(header_size + message_length)
+				logs.append(self.decode(record[:header_size], record[header_size:]))
+
+		if count > 0:
+			file.get_stream("read", read)
+
+		logs.reverse()
+		return logs
+
+	def convert_from_text(self, text_file: EasyFile, binary_file: EasyFile, batch_size: int = 1024) -> int:
+		"""
+		Writes every entry of a text log to a binary log, the text log
+		is read a line at a time. Returns the number of entries converted
+		"""
+		text_format = LogFileFormat()
+		converted = 0
+
+		def write(binary_stream: BinaryIO):
+			def read(text_stream: BinaryIO):
+				nonlocal converted
+				batch: List[bytes] = []
+
+				for line_num, line in enumerate(text_stream, 1):
+					logdata = text_format.parse_line(line)
+					if logdata is None:
+						raise FileDecodeError(f"One or more log entries were invalid (First line fail: {line_num})")
+
+					batch.append(self.encode(logdata))
+
+					if len(batch) >= batch_size:
+						binary_stream.write(b"".join(batch))
+						converted += len(batch)
+						batch = []
+
+				binary_stream.write(b"".join(batch))
+				converted += len(batch)
+
+			text_file.get_stream("read", read)
+
+		binary_file.get_stream("write", write)
+		return converted
+
+def append_encoded(file: EasyFile, records: List[bytes], sync: bool = False) -> List[int]:
+	"""
+	Appends already encoded records with a single write and returns the
+	offset each one was written at
+	"""
+	def write(stream: BinaryIO) -> List[int]:
+		offsets: List[int] = []
+		offset = stream.seek(0, 2)
+
+		for record in records:
+			offsets.append(offset)
+			offset += len(record)
+
+		stream.write(b"".join(records))
+
+		if sync:
+			stream.flush()
+			fsync(stream.fileno())
+
+		return offsets
+
+	return file.get_stream("append", write)
+
+class LogSegment(NamedTuple):
+	number: int
+	start: int # Epoch of the first entry
+	end: int # Epoch of the last entry
+	count: int
+	compression: int
+	binary: bool
+
+class LogCompression:
+
+	NONE = 0
+	ZLIB = 1
+	LZMA = 2
+
+	@staticmethod
+	def compress(compression: int, data: bytes) -> bytes:
+		if compression == LogCompression.ZLIB:
+			return zlib.compress(data, 9)
+		elif compression == LogCompression.LZMA:
+			return lzma.compress(data)
+
+		return data
+
+	@staticmethod
+	def decompress(compression: int, data: bytes) -> bytes:
+		try:
+			if compression == LogCompression.ZLIB:
+				return zlib.decompress(data)
+			elif compression == LogCompression.LZMA:
+				return lzma.decompress(data)
+		except (zlib.error, lzma.LZMAError):
+			raise FileDecodeError("Log segment couldn't be decompressed")
+
+		return data
+
+class LogManifestFileData(EasyFileData):
+	"""
+	Archived log segments, oldest first
+	"""
+
+	def __init__(self):
+		self.segments: List[LogSegment] = []
+
+	@property
+	def next_number(self) -> int:
+		return self.segments[-1].number + 1 if len(self.segments) else 1
+
+class LogManifestFileFormat(EasyFileFormat, data = LogManifestFileData):
+	"""
+	Log manifest file format
+	"""
+
+	def from_file(self, file: EasyFile) -> LogManifestFileData:
+		data = LogManifestFileData()
+
+		def read(view: memoryview):
+			if len(view) % codec.LOG_SEGMENT.size:
+				raise FileDecodeError("EOF reached at an invalid point in log manifest file")
+
+			data.segments.extend([LogSegment(*fields[:5], bool(fields[5])) for fields in codec.LOG_SEGMENT.iter_unpack(view)])
+
+		file.get_view(read)
+		return data
+
+	def save_to(self, file: EasyFile, data: LogManifestFileData) -> bool:
+		def write(stream: BinaryIO):
+			stream.write(b"".join([codec.LOG_SEGMENT.pack(*segment) for segment in data.segments]))
+
+		file.get_stream("write", write)
+		return True
+
+class LogIndexFileData(EasyFileData):
+	"""
+	Sparse index of a log segment
+
+	buckets holds the offset of the first entry written in each time
+	bucket, types holds the epoch and offset of every entry by its log
+	type's byte. Offsets are into the uncompressed segment
+	"""
+
+	def __init__(self):
+		self.buckets: List[Tuple[int, int]] = [] # (bucket epoch, offset)
+		self.types: Dict[int, List[Tuple[int, int]]] = {} # type id: [(epoch, offset)]
+
+	def start_offset(self, since: int = None) -> Union[int, None]:
+		"""
+		Offset of the first entry that could be at or after since, None if
+		every entry is before it
+		"""
+		if since is None or not len(self.buckets):
+			return 0
+
+		# First bucket that ends after since, every entry before it is too old
+		index = bisect_right([bucket for bucket, _ in self.buckets], since - LogIndexFileFormat.BUCKET_SECONDS)
+		return self.buckets[index][1] if index < len(self.buckets) else None
+
+	def covers_start(self) -> bool:
+		"""
+		If the index starts at the segment's first entry, an index made
+		part way through a segment can't be used for queries
+		"""
+		return len(self.buckets) > 0 and self.buckets[0][1] == 0
+
+	def type_offsets(self, type_id: int, since: int = None, until: int = None) -> List[int]:
+		entries = self.types.get(type_id, [])
+		epochs = [epoch for epoch, _ in entries]
+
+		start = 0 if since is None else bisect_left(epochs, since)
+		end = len(entries) if until is None else bisect_right(epochs, until)
+		return [offset for _, offset in entries[start:end]]
+
+class LogIndexFileFormat(EasyFileFormat, data = LogIndexFileData):
+	"""
+	Log index file format
+
+	Append only records of a kind byte, an epoch and an offset. The kind
+	is BUCKET for the first entry in a time bucket, otherwise it's the
+	entry's log type byte
+	"""
+
+	BUCKET = 255
+	BUCKET_SECONDS = 600
+
+	def records_for(self, logs: List["logger.LogData"], offsets: List[int], last_bucket: int = None) -> Tuple[bytes, int]:
+		"""
+		Builds the index records for entries that were written at offsets,
+		returns the records and the newest bucket
+		"""
+		records: List[bytes] = []
+
+		for log, offset in zip(logs, offsets):
+			epoch = log.timestamp.epoch
+			bucket = epoch - epoch % LogIndexFileFormat.BUCKET_SECONDS
+
+			if last_bucket is None or bucket > last_bucket:
+				records.append(codec.LOG_INDEX_RECORD.pack(LogIndexFileFormat.BUCKET, bucket, offset))
+				last_bucket = bucket
+
+			records.append(codec.LOG_INDEX_RECORD.pack(logger.LogTypes.type_ids.get(log.logtype.lower(), 0), epoch, offset))
+
+		return b"".join(records), last_bucket
+
+	def from_file(self, file: EasyFile) -> LogIndexFileData:
+		data = LogIndexFileData()
+
+		def read(view: memoryview):
+			records = view[:len(view) - len(view) % codec.LOG_INDEX_RECORD.size] # Drop a record cut off by a crash
+
+			for kind, epoch, offset in codec.LOG_INDEX_RECORD.iter_unpack(records):
+				if kind == LogIndexFileFormat.BUCKET:
+					data.buckets.append((epoch, offset))
+				else:
+					data.types.setdefault(kind, []).append((epoch, offset))
+
+		file.get_view(read)
+		return data
+
+	def append_to(self, file: EasyFile, records: bytes) -> bool:
+		def write(stream: BinaryIO):
+			stream.write(records)
+
+		file.get_stream("append", write)
+		return True
+
 class ConfigFileData(EasyFileData):
 	"""
 	A "config" file's data
@@ -241,42 +825,39 @@ class ConfigFileFormat(EasyFileFormat, data = ConfigFileData):
 	def from_file(self, file: EasyFile) -> ConfigFileData:
 		data = ConfigFileData()
 
-		def read(stream: BinaryIO):
-			while True:
+		def read(view: memoryview):
+			offset = 0
+			while offset < len(view):
 				try:
-					key_length_data = stream.read(2)
-					if len(key_length_data) != 2:
-						if not len(key_length_data): # EOF at the right time
-							break
-
+					if len(view) - offset < 2:
 						raise FileDecodeError("EOF reached at an invalid point in config file (1)")
 
-					key_length = from_base256(key_length_data)
-					key_value = stream.read(key_length)
+					key_length = codec.UINT16.unpack_from(view, offset)[0]
+					offset += 2
 
-					if len(key_value) != key_length:
+					if len(view) - offset < key_length:
 						raise FileDecodeError("EOF reached at an invalid point in config file (2)")
 
-					key_value = key_value.decode("unicode_escape")
+					key_value = bytes(view[offset:offset + key_length]).decode("unicode_escape")
+					offset += key_length
 
-					value_length_data = stream.read(2)
-
-					if len(value_length_data) != 2:
+					if len(view) - offset < 2:
 						raise FileDecodeError("EOF reached at an invalid point in config file (3)")
 
-					value_length = from_base256(value_length_data)
-					value_value = stream.read(value_length)
+					value_length = codec.UINT16.unpack_from(view, offset)[0]
+					offset += 2
 
-					if len(value_value) != value_length:
+					if len(view) - offset < value_length:
 						raise FileDecodeError("EOF reached at an invalid point in config file (4)")
 
-					value_value = value_value.decode("unicode_escape")
+					value_value = bytes(view[offset:offset + value_length]).decode("unicode_escape")
+					offset += value_length
 
 					data.data[key_value] = value_value
 				except UnicodeDecodeError:
 					raise FileDecodeError("Invalid character, cannot decode config file (5)")
 
-		file.get_stream("read", read)
+		file.get_view(read)
 		return data
 
 	def save_to(self, file: EasyFile, data: ConfigFileData) -> bool:
@@ -285,12 +866,12 @@ class ConfigFileFormat(EasyFileFormat, data = ConfigFileData):
 				key = repr(key)[1:-1].encode("utf-8")
 				value = repr(value)[1:-1].encode("utf-8")
 
-				key_length = len(key)
-				value_length = len(value)
+				if len(key) > 65535 or len(value) > 65535:
+					raise FileEncodeError("Config key or value is too long to be saved")
 
-				stream.write(bytes([key_length // 256, key_length % 256]))
+				stream.write(codec.UINT16.pack(len(key)))
 				stream.write(key)
-				stream.write(bytes([value_length // 256, value_length % 256]))
+				stream.write(codec.UINT16.pack(len(value)))
 				stream.write(value)
 
 		file.get_stream("write", write)
@@ -303,8 +884,9 @@ class SessionFileData(EasyFileData):
 
 	def __init__(self, expires: int = None, step: int = None, past_random: bytes = None, present_random: bytes = None, \
 		future_random: bytes = None, shared_aes: bytes = None, server_rsa_public: bytes = None, server_rsa_private: bytes = None, \
-		client_rsa_public: bytes = None, client_rsa_private: bytes = None):
+		client_rsa_public: bytes = None, client_rsa_private: bytes = None, version: int = None):
 
+		self.version = version # Layout the data was read from
 		self.expires = expires
 		self.step = step
 		self.past_random = past_random
@@ -347,143 +929,184 @@ class SessionFileFormat(EasyFileFormat, data = SessionFileData):
 		return (key_byte & bitmask) == bitmask
 
 	def from_file(self, file: EasyFile) -> SessionFileData:
-		data = SessionFileData()
+		return file.get_view(self.from_buffer)
 
-		def read(stream: BinaryIO):
-			expires_length_bytes = stream.read(4)
-			if len(expires_length_bytes) != 4:
-				raise FileDecodeError("EOF reached at an invalid point in session file (1)")
+	def from_buffer(self, buffer: Union[bytes, memoryview]) -> SessionFileData:
+		"""
+		Decodes a session from its bytes, fields are copied out of buffer
+		"""
+		data = SessionFileData()
 
-			expires_length = from_base256(expires_length_bytes)
-			expires_bytes = stream.read(expires_length)
+		if len(buffer) < 4:
+			raise FileDecodeError("EOF reached at an invalid point in session file (1)")
 
-			if len(expires_bytes) != expires_length:
-				raise FileDecodeError("EOF reached at an invalid point in session file (2)")
+		expires_length = codec.UINT32.unpack_from(buffer, 0)[0]
+		offset = 4
 
-			data.expires = from_base256(expires_bytes)
-			del expires_length_bytes, expires_length, expires_bytes
+		if len(buffer) - offset < expires_length:
+			raise FileDecodeError("EOF reached at an invalid point in session file (2)")
 
-			step_length_bytes = stream.read(2)
-			if len(step_length_bytes) != 2:
-				raise FileDecodeError("EOF reached at an invalid point in session file (3)")
+		data.expires = codec.decode_uint(buffer[offset:offset + expires_length])
+		offset += expires_length
 
-			step_length = from_base256(step_length_bytes)
-			step_bytes = stream.read(step_length)
+		if len(buffer) - offset < 2:
+			raise FileDecodeError("EOF reached at an invalid point in session file (3)")
 
-			if len(step_bytes) != step_length:
-				raise FileDecodeError("EOF reached at an invalid point in session file (4)")
+		step_length = codec.UINT16.unpack_from(buffer, offset)[0]
+		offset += 2
 
-			data.step = from_base256(step_bytes)
-			del step_length_bytes, step_length, step_bytes
+		if len(buffer) - offset < step_length:
+			raise FileDecodeError("EOF reached at an invalid point in session file (4)")
 
-			past_random = stream.read(32)
+		data.step = codec.decode_uint(buffer[offset:offset + step_length])
+		offset += step_length
 
-			if len(past_random) != 32:
-				raise FileDecodeError("EOF reached at an invalid point in session file (5)")
+		for error, name in ((5, "past_random"), (6, "present_random"), (7, "future_random")):
+			if len(buffer) - offset < 32:
+				raise FileDecodeError(f"EOF reached at an invalid point in session file ({error})")
 
-			data.past_random = past_random
-			del past_random
+			setattr(data, name, bytes(buffer[offset:offset + 32]))
+			offset += 32
 
-			present_random = stream.read(32)
+		if len(buffer) - offset < 1:
+			raise FileDecodeError("EOF reached at an invalid point in session file (8)")
 
-			if len(present_random) != 32:
-				raise FileDecodeError("EOF reached at an invalid point in session file (6)")
+		key_byte = buffer[offset]
+		offset += 1
 
-			data.present_random = present_random
-			del present_random
+		if SessionFileFormat.has(key_byte, SessionFileFormat.SHARED_AES_BITMASK):
+			if len(buffer) - offset < 32:
+				raise FileDecodeError("EOF reached at an invalid point in session file (9)")
 
-			future_random = stream.read(32)
+			data.shared_aes = bytes(buffer[offset:offset + 32])
+			offset += 32
 
-			if len(future_random) != 32:
-				raise FileDecodeError("EOF reached at an invalid point in session file (7)")
+		for error, bitmask, name in ((10, SessionFileFormat.SERVER_RSA_PUBLIC_BITMASK, "server_rsa_public"), (12, SessionFileFormat.SERVER_RSA_PRIVATE_BITMASK, "server_rsa_private"), \
+			(14, SessionFileFormat.CLIENT_RSA_PUBLIC_BITMASK, "client_rsa_public"), (16, SessionFileFormat.CLIENT_RSA_PRIVATE_BITMASK, "client_rsa_private")):
 
-			data.future_random = future_random
-			del future_random
+			if SessionFileFormat.has(key_byte, bitmask):
+				if len(buffer) - offset < 2:
+					raise FileDecodeError(f"EOF reached at an invalid point in session file ({error})")
 
-			key_byte = stream.read(1)
+				key_length = codec.UINT16.unpack_from(buffer, offset)[0]
+				offset += 2
 
-			if len(key_byte) != 1:
-				raise FileDecodeError("EOF reached at an invalid point in session file (8)")
+				if len(buffer) - offset < key_length:
+					raise FileDecodeError(f"EOF reached at an invalid point in session file ({error + 1})")
 
-			if SessionFileFormat.has(key_byte, SessionFileFormat.SHARED_AES_BITMASK):
-				shared_aes = stream.read(32)
+				setattr(data, name, bytes(buffer[offset:offset + key_length]))
+				offset += key_length
 
-				if len(shared_aes) != 32:
-					raise FileDecodeError("EOF reached at an invalid point in session file (9)")
+		return data
 
-				data.shared_aes = shared_aes
-				del shared_aes
+	def save_to(self, file: EasyFile, data: SessionFileData) -> bool:
+		def write(stream: BinaryIO):
+			expires_bytes = codec.encode_uint(data.expires)
+			step_bytes = codec.encode_uint(data.step)
 
-			if SessionFileFormat.has(key_byte, SessionFileFormat.SERVER_RSA_PUBLIC_BITMASK):
-				server_rsa_public_length_bytes = stream.read(2)
+			stream.write(codec.UINT32.pack(len(expires_bytes)) + expires_bytes)
+			stream.write(codec.UINT16.pack(len(step_bytes)) + step_bytes)
+			stream.write(data.past_random)
+			stream.write(data.present_random)
+			stream.write(data.future_random)
 
-				if len(server_rsa_public_length_bytes) != 2:
-					raise FileDecodeError("EOF reached at an invalid point in session file (10)")
+			stream.write(SessionFileFormat.generate_key_byte(data))
+			if data.shared_aes:
+				stream.write(data.shared_aes)
+			if data.server_rsa_public:
+				stream.write(add_length_data(data.server_rsa_public, 2, 2))
+			if data.server_rsa_private:
+				stream.write(add_length_data(data.server_rsa_private, 2, 2))
+			if data.client_rsa_public:
+				stream.write(add_length_data(data.client_rsa_public, 2, 2))
+			if data.client_rsa_private:
+				stream.write(add_length_data(data.client_rsa_private, 2, 2))
 
-				server_rsa_public_length = from_base256(server_rsa_public_length_bytes)
-				server_rsa_public = stream.read(server_rsa_public_length)
+		file.get_stream("write", write)
+		return True
 
-				if len(server_rsa_public) != server_rsa_public_length:
-					raise FileDecodeError("EOF reached at an invalid point in session file (11)")
+class SessionFileFormatV2(EasyFileFormat, data = SessionFileData):
+	"""
+	Session file format with the fields that change on every packet at
+	fixed offsets
+
+	Layout:
+		magic (4) "HSS\\x02"
+		expires (4), step (2), past random (32), present random (32),
+		future random (32)
+		key byte (1)
+		key section, same as SessionFileFormat
+
+	The expires, step and random fields can be updated in place with
+	update_hot, the key section is only written by save_to. Files in the
+	original layout are still read by from_file and are migrated the next
+	time save_to is used on them.
+	"""
 
-				data.server_rsa_public = server_rsa_public
-				del server_rsa_public_length_bytes, server_rsa_public_length, server_rsa_public
+	MAGIC = b"HSS\x02"
 
-			if SessionFileFormat.has(key_byte, SessionFileFormat.SERVER_RSA_PRIVATE_BITMASK):
-				server_rsa_private_length_bytes = stream.read(2)
+	HOT_OFFSET = len(MAGIC)
+	KEY_BYTE_OFFSET = HOT_OFFSET + 102 # codec.SESSION_HOT_FIELDS.size
+	KEY_SECTION_OFFSET = KEY_BYTE_OFFSET + 1
 
-				if len(server_rsa_public_length_bytes) != 2:
-					raise FileDecodeError("EOF reached at an invalid point in session file (12)")
+	def is_v2(self, file: EasyFile) -> bool:
+		def read(stream: BinaryIO):
+			return stream.read(len(SessionFileFormatV2.MAGIC)) == SessionFileFormatV2.MAGIC
 
-				server_rsa_private_length = from_base256(server_rsa_private_length_bytes)
-				server_rsa_private = stream.read(server_rsa_private_length)
+		return bool(file.get_stream("read", read))
 
-				if len(server_rsa_private) != server_rsa_private_length:
-					raise FileDecodeError("EOF reached at an invalid point in session file (13)")
+	def from_file(self, file: EasyFile) -> SessionFileData:
+		return file.get_view(self.from_buffer)
 
-				data.server_rsa_private = server_rsa_private
-				del server_rsa_private_length_bytes, server_rsa_private_length, server_rsa_private
+	def from_buffer(self, buffer: Union[bytes, memoryview]) -> SessionFileData:
+		"""
+		Decodes a session in either layout from its bytes, fields are
+		copied out of buffer
+		"""
+		if bytes(buffer[:len(SessionFileFormatV2.MAGIC)]) != SessionFileFormatV2.MAGIC:
+			data = SessionFileFormat().from_buffer(buffer)
+			data.version = 1
+			return data
 
-			if SessionFileFormat.has(key_byte, SessionFileFormat.CLIENT_RSA_PUBLIC_BITMASK):
-				client_rsa_public_length_bytes = stream.read(2)
+		if len(buffer) < SessionFileFormatV2.KEY_SECTION_OFFSET:
+			raise FileDecodeError("EOF reached at an invalid point in session file (1)")
 
-				if len(client_rsa_public_length_bytes) != 2:
-					raise FileDecodeError("EOF reached at an invalid point in session file (14)")
+		data = SessionFileData(version = 2)
+		data.expires, data.step, data.past_random, data.present_random, data.future_random = \
+			codec.SESSION_HOT_FIELDS.unpack_from(buffer, SessionFileFormatV2.HOT_OFFSET)
 
-				client_rsa_public_length = from_base256(client_rsa_public_length_bytes)
-				client_rsa_public = stream.read(client_rsa_public_length)
+		key_byte = buffer[SessionFileFormatV2.KEY_BYTE_OFFSET]
+		offset = SessionFileFormatV2.KEY_SECTION_OFFSET
 
-				if len(client_rsa_public) != client_rsa_public_length:
-					raise FileDecodeError("EOF reached at an invalid point in session file (15)")
+		if SessionFileFormat.has(key_byte, SessionFileFormat.SHARED_AES_BITMASK):
+			if len(buffer) - offset < 32:
+				raise FileDecodeError("EOF reached at an invalid point in session file (2)")
 
-				data.client_rsa_public = client_rsa_public
-				del client_rsa_public_length_bytes, client_rsa_public_length, client_rsa_public
+			data.shared_aes = bytes(buffer[offset:offset + 32])
+			offset += 32
 
-			if SessionFileFormat.has(key_byte, SessionFileFormat.CLIENT_RSA_PRIVATE_BITMASK):
-				client_rsa_private_length_bytes = stream.read(2)
+		for bitmask, name in ((SessionFileFormat.SERVER_RSA_PUBLIC_BITMASK, "server_rsa_public"), (SessionFileFormat.SERVER_RSA_PRIVATE_BITMASK, "server_rsa_private"), \
+			(SessionFileFormat.CLIENT_RSA_PUBLIC_BITMASK, "client_rsa_public"), (SessionFileFormat.CLIENT_RSA_PRIVATE_BITMASK, "client_rsa_private")):
 
-				if len(client_rsa_public_length_bytes) != 2:
-					raise FileDecodeError("EOF reached at an invalid point in session file (16)")
+			if SessionFileFormat.has(key_byte, bitmask):
+				if len(buffer) - offset < 2:
+					raise FileDecodeError("EOF reached at an invalid point in session file (3)")
 
-				client_rsa_private_length = from_base256(client_rsa_private_length_bytes)
-				client_rsa_private = stream.read(client_rsa_private_length)
+				key_length = codec.UINT16.unpack_from(buffer, offset)[0]
+				offset += 2
 
-				if len(client_rsa_private) != client_rsa_private_length:
-					raise FileDecodeError("EOF reached at an invalid point in session file (17)")
+				if len(buffer) - offset < key_length:
+					raise FileDecodeError("EOF reached at an invalid point in session file (4)")
 
-				data.client_rsa_private = client_rsa_private
-				del client_rsa_private_length_bytes, client_rsa_private_length, client_rsa_private
+				setattr(data, name, bytes(buffer[offset:offset + key_length]))
+				offset += key_length
 
-		file.get_stream("read", read)
 		return data
 
 	def save_to(self, file: EasyFile, data: SessionFileData) -> bool:
 		def write(stream: BinaryIO):
-			stream.write(add_length_data(to_base256(data.expires), 4, 4))
-			stream.write(add_length_data(to_base256(data.step), 2, 2))
-			stream.write(data.past_random)
-			stream.write(data.present_random)
-			stream.write(data.future_random)
+			stream.write(SessionFileFormatV2.MAGIC)
+			stream.write(codec.SESSION_HOT_FIELDS.pack(data.expires, data.step, data.past_random, data.present_random, data.future_random))
 
 			stream.write(SessionFileFormat.generate_key_byte(data))
 			if data.shared_aes:
@@ -497,13 +1120,114 @@ class SessionFileFormat(EasyFileFormat, data = SessionFileData):
 			if data.client_rsa_private:
 				stream.write(add_length_data(data.client_rsa_private, 2, 2))
 
+		file.get_stream("write", write)
+		data.version = 2
+		return True
+
+	def read_expires(self, file: EasyFile) -> int:
+		"""
+		Reads only when a session in either layout expires
+		"""
+		def read(stream: BinaryIO):
+			head = stream.read(SessionFileFormatV2.KEY_BYTE_OFFSET)
+
+			if head[:len(SessionFileFormatV2.MAGIC)] == SessionFileFormatV2.MAGIC:
+				if len(head) < SessionFileFormatV2.KEY_BYTE_OFFSET:
+					raise FileDecodeError("EOF reached at an invalid point in session file (1)")
+
+				return codec.UINT32.unpack_from(head, SessionFileFormatV2.HOT_OFFSET)[0]
+
+			if len(head) < 4: # Original layout, the expires' length then expires
+				raise FileDecodeError("EOF reached at an invalid point in session file (1)")
+
+			expires_length = codec.UINT32.unpack_from(head, 0)[0]
+			expires = head[4:4 + expires_length]
+			expires += stream.read(expires_length - len(expires))
+
+			if len(expires) != expires_length:
+				raise FileDecodeError("EOF reached at an invalid point in session file (2)")
+
+			return codec.decode_uint(expires)
+
+		return file.get_stream("read", read)
+
+	def update_hot(self, file: EasyFile, data: SessionFileData) -> bool:
+		"""
+		Writes only the expires, step and random fields with a single
+		pwrite. Returns False without writing anything if the file isn't
+		in the v2 layout, save_to should be used instead
+		"""
+		hot = codec.SESSION_HOT_FIELDS.pack(data.expires, data.step, data.past_random, data.present_random, data.future_random)
+
+		def update(stream: BinaryIO):
+			fd = stream.fileno()
+			if pread(fd, len(SessionFileFormatV2.MAGIC), 0) != SessionFileFormatV2.MAGIC:
+				return False
+
+			return pwrite(fd, hot, SessionFileFormatV2.HOT_OFFSET) == len(hot)
+
+		return file.get_stream("update", update)
+
+	def migrate(self, file: EasyFile) -> bool:
+		"""
+		Rewrites a session file in the original layout as v2, returns
+		if the file was migrated
+		"""
+		if self.is_v2(file):
+			return False
+
+		return self.save_to(file, SessionFileFormat().from_file(file))
+
+class KeyPoolFileData(EasyFileData):
+	"""
+	Spare keys of the key pool, each one is stored already encrypted
+	"""
+
+	def __init__(self):
+		self.keys: List[bytes] = []
+
+class KeyPoolFileFormat(EasyFileFormat, data = KeyPoolFileData):
+	"""
+	Key pool file format
+	"""
+
+	def from_file(self, file: EasyFile) -> KeyPoolFileData:
+		data = KeyPoolFileData()
+
+		def read(view: memoryview):
+			offset = 0
+			while offset < len(view):
+				if len(view) - offset < 2:
+					raise FileDecodeError("EOF reached at an invalid point in key pool file (1)")
+
+				key_length = codec.UINT16.unpack_from(view, offset)[0]
+				offset += 2
+
+				if len(view) - offset < key_length:
+					raise FileDecodeError("EOF reached at an invalid point in key pool file (2)")
+
+				data.keys.append(bytes(view[offset:offset + key_length]))
+				offset += key_length
+
+		file.get_view(read)
+		return data
+
+	def save_to(self, file: EasyFile, data: KeyPoolFileData) -> bool:
+		def write(stream: BinaryIO):
+			for key in data.keys:
+				if len(key) > 65535:
+					raise FileEncodeError("Key is too long to be saved in the key pool")
+
+				stream.write(codec.UINT16.pack(len(key)) + key)
+
 		file.get_stream("write", write)
 		return True
 
 class FileUtil:
 
 	@staticmethod
-	def root() -> str: return str(pathlib.Path(__file__).parent.absolute().resolve())
+	@lru_cache(maxsize = None)
+	def root() -> str: return str(pathlib.Path(__file__).parent.absolute().resolve()) # Resolving walks the path, it never changes
 
 	@staticmethod
 	def checksum(data: Union[List[bytes], bytes]) -> bytes:
@@ -527,6 +1251,17 @@ class FileUtil:
 
 		return not FileUtil.does_file_exist(filepath)
 
+	@staticmethod
+	def sync_directory(folderpath: str) -> None:
+		"""
+		Makes renames and new files in a folder durable
+		"""
+		fd = fdesk(folderpath, O_RDONLY)
+		try:
+			fsync(fd)
+		finally:
+			fdclose(fd)
+
 	@staticmethod
 	def write_lines(file: EasyFile, lines: List[bytes]) -> None:
 		def write(stream: BinaryIO):
@@ -543,19 +1278,17 @@ class FileUtil:
 
 	@staticmethod
 	def extend_lines(file: EasyFile, lines_out: List[bytes]) -> None:
-		def read(stream: BinaryIO):
-			lines_out.extend(stream.readlines())
+		def read(view: memoryview):
+			lines_out.extend(bytes(view).splitlines(True))
 
-		file.get_stream("read", read)
+		file.get_view(read)
 
 	@staticmethod
 	def read_lines(file: EasyFile) -> List[bytes]:
 		lines: List[bytes] = []
-		def read(stream: BinaryIO):
-			lines.extend(stream.readlines())
-
-		file.get_stream("read", read)
+		FileUtil.extend_lines(file, lines)
 		return lines
 
 import logger
-from networking.packet import to_base256, from_base256, add_length_data
\ No newline at end of file
+from networking import codec
+from networking.packet import add_length_data
\ No newline at end of file
@@ -1,7 +1,12 @@
 import sys
-from queue import Queue
+from collections import deque
+from threading import Condition, Lock, RLock, get_ident
 from datetime import datetime
-from typing import List, NamedTuple
+from io import BytesIO
+from os import replace
+from os.path import getsize
+from time import monotonic_ns, sleep, time
+from typing import BinaryIO, Callable, Deque, Dict, List, NamedTuple, Tuple, Union
 from colorama import Fore, Back, Style, init
 
 import io_handles
@@ -30,6 +35,19 @@ class LogTypes:
 
 	types = tuple(logtypes.keys())
 
+	# Lowest level that's logged is set by "log_level" in the config
+	levels = {
+		"debug":   0,
+		"info":    1,
+		"install": 1,
+		"safe":    1,
+		"warn":    2,
+		"exit":    2,
+		"error":   3
+	}
+
+	type_ids = {logtype: type_id for type_id, logtype in enumerate(types)} # Binary log type byte, only ever append new types
+
 	@staticmethod
 	def is_valid_type(logtype: str):
 		return isinstance(logtype, str) and logtype.lower() in LogTypes.logtypes
@@ -40,10 +58,52 @@ class LogTypes:
 			return LogTypes.logtypes[logtype.lower()]
 
 class TimestampData:
+	"""
+	Date and time strings are only formatted when they're first used if
+	the timestamp was made from an epoch
+	"""
+
+	def __init__(self, date: str = None, time: str = None, epoch: int = None):
+		self.__date = date
+		self.__time = time
+		self.__epoch = epoch
+
+	@property
+	def date(self) -> str:
+		if self.__date is None:
+			self.__date = datetime.fromtimestamp(self.__epoch).strftime("%d/%m/%Y")
+
+		return self.__date
+
+	@date.setter
+	def date(self, date: str) -> None:
+		if self.__time is None:
+			self.__time = self.time # Keep the time from the epoch that's being replaced
+
+		self.__date = date
+		self.__epoch = None
+
+	@property
+	def time(self) -> str:
+		if self.__time is None:
+			self.__time = datetime.fromtimestamp(self.__epoch).strftime("%H:%M:%S")
+
+		return self.__time
+
+	@time.setter
+	def time(self, time: str) -> None:
+		if self.__date is None:
+			self.__date = self.date
+
+		self.__time = time
+		self.__epoch = None
 
-	def __init__(self, date: str, time: str):
-		self.date = date
-		self.time = time
+	@property
+	def epoch(self) -> int:
+		if self.__epoch is None:
+			self.__epoch = int(datetime.strptime(f"{self.date} {self.time}", "%d/%m/%Y %H:%M:%S").timestamp())
+
+		return self.__epoch
 
 class Timestamp:
 
@@ -51,6 +111,9 @@ class Timestamp:
 		if date is None or time is None:
 			now = datetime.now()
 
+		if date is None and time is None:
+			return TimestampData(epoch = int(now.timestamp()))
+
 		if date is None:
 			date = now.strftime("%d/%m/%Y")
 		if time is None:
@@ -58,6 +121,10 @@ class Timestamp:
 
 		return TimestampData(date, time)
 
+	@staticmethod
+	def from_epoch(epoch: int) -> TimestampData:
+		return TimestampData(epoch = epoch)
+
 class LogData(NamedTuple):
 	logtype: str
 	unsafe_message: str
@@ -74,83 +141,319 @@ class LogData(NamedTuple):
 	def __repr__(self):
 		return f"{self.timestamp.date} :: {self.timestamp.time} [{self.logtype.title()}] {self.message}"
 
+class PendingLog:
+	"""
+	A log that hasn't been formatted yet
+
+	The message can be a string or a callable returning one, it's only
+	called, stripped and escaped by render which the logger's threads
+	call. The time is kept as epoch seconds and monotonic nanoseconds
+	"""
+
+	__slots__ = ("logtype", "message", "epoch", "monotonic", "__rendered")
+
+	def __init__(self, logtype: str, message: Union[str, Callable[[], str]]):
+		self.logtype = logtype
+		self.message = message
+		self.epoch = int(time())
+		self.monotonic = monotonic_ns()
+		self.__rendered: LogData = None
+
+	def render(self) -> LogData:
+		if self.__rendered is None:
+			message = self.message() if callable(self.message) else self.message
+
+			if message is None or not isinstance(message, str):
+				message = "No message provided"
+
+			message = message.rstrip()
+			self.__rendered = LogData(self.logtype, message, repr(message)[1:-1], Timestamp.from_epoch(self.epoch))
+
+		return self.__rendered
+
+	def __str__(self): return str(self.render())
+
+	def __repr__(self): return repr(self.render())
+
 class Log:
+	"""
+	Queues a log with the logger, returns None without doing any work if
+	the log type is below the logger's level
 
-	def __new__(cls, logtype: str, message: str, save: bool = True, print: bool = False) -> LogData:
+	Pass a callable as the message to have it built on the logger's thread
+	"""
+
+	def __new__(cls, logtype: str, message: Union[str, Callable[[], str]], save: bool = True, print: bool = False) -> Union[PendingLog, None]:
 		if not LogTypes.is_valid_type(logtype):
 			logtype = LogTypes.Info
-		
-		if message is None or not isinstance(message, str):
-			message = "No message provided"
+
+		if not Logger.get_logger().is_enabled(logtype):
+			return None
 
 		if logtype.lower() == "debug":
 			save = False
 
-		message = message.rstrip()
-
-		logdata = LogData(logtype, message, repr(message)[1:-1], Timestamp())
+		pending = PendingLog(logtype, message)
 
 		if save:
-			Logger.get_logger().save(logdata)
+			Logger.get_logger().save(pending)
 
 		if print:
-			Logger.get_logger().print(logdata)
+			Logger.get_logger().print(pending)
+
+		return pending
+
+class OverflowPolicy:
+
+	Block          = "block"            # Wait for the logger thread to make room
+	DropOldest     = "drop-oldest"      # Drop the log that has waited the longest
+	DropDebugFirst = "drop-debug-first" # Drop a debug log, new or queued, otherwise the oldest log
+
+	policies = (Block, DropOldest, DropDebugFirst)
+
+	@staticmethod
+	def is_valid_policy(policy: str) -> bool:
+		return isinstance(policy, str) and policy.lower() in OverflowPolicy.policies
+
+class LogQueue:
+	"""
+	Bounded queue of logs waiting on one of the logger's threads
+
+	When the queue is full put follows the overflow policy, the thread
+	draining the queue never blocks on it. dropped counts every log that
+	was thrown away to make room
+	"""
+
+	def __init__(self, maxsize: int, policy: str = OverflowPolicy.DropDebugFirst):
+		self.maxsize = maxsize
+		self.policy = policy.lower() if OverflowPolicy.is_valid_policy(policy) else OverflowPolicy.DropDebugFirst
+		self.dropped = 0
+
+		self.__logs: Deque[Union[LogData, PendingLog]] = deque()
+		self.__lock = Lock()
+		self.__not_empty = Condition(self.__lock)
+		self.__not_full = Condition(self.__lock)
+		self.__consumer: int = None # Thread id of the last thread to drain the queue
+
+	def __len__(self) -> int:
+		return len(self.__logs)
+
+	def empty(self) -> bool:
+		return not len(self.__logs)
+
+	def put(self, log: LogData) -> bool:
+		"""
+		Queues a log, returns False if the log itself was dropped
+		"""
+		with self.__lock:
+			if len(self.__logs) >= self.maxsize:
+				if self.policy == OverflowPolicy.Block and get_ident() != self.__consumer:
+					while len(self.__logs) >= self.maxsize:
+						self.__not_full.wait()
+
+				elif not self.__make_room(log):
+					return False
 
-		return logdata
+			self.__logs.append(log)
+			self.__not_empty.notify()
+			return True
+
+	def get_batch(self, count: int, timeout: float = None) -> List[LogData]:
+		"""
+		Takes up to count logs, waits up to timeout seconds for the first
+		one. Doesn't wait if timeout is 0
+		"""
+		with self.__lock:
+			self.__consumer = get_ident()
+
+			if not len(self.__logs) and timeout != 0:
+				self.__not_empty.wait(timeout)
+
+			batch = [self.__logs.popleft() for _ in range(min(count, len(self.__logs)))]
+
+			if len(batch):
+				self.__not_full.notify_all()
+
+			return batch
+
+	def __make_room(self, log: LogData) -> bool:
+		self.dropped += 1
+
+		if self.policy == OverflowPolicy.DropDebugFirst:
+			if log.logtype.lower() == LogTypes.Debug:
+				return False
+
+			for index, queued in enumerate(self.__logs):
+				if queued.logtype.lower() == LogTypes.Debug:
+					del self.__logs[index]
+					return True
+
+		self.__logs.popleft()
+		return True
 
 class Logger:
+	"""
+	Saves and prints logs from background threads
+
+	Saved logs are appended to the log file in batches of up to
+	SAVE_BATCH_SIZE entries with one write per batch, if fsync is
+	True every batch is also synced to disk
+
+	The log file is the active segment. Once it reaches max_segment_size
+	bytes or its first entry is max_segment_age seconds old it is
+	compressed into logs/log.<number>.homesec and recorded in the
+	manifest
+
+	Starting the logger only finds the active segment, its history is
+	read the first time log_data is used and the threads (and colorama)
+	are started by the first save or print
+
+	Logs are kept as text unless "log_format" is "binary" in the config
+
+	Logs wait in bounded queues of "log_queue_size" entries, when one is
+	full "log_overflow_policy" decides what happens, see OverflowPolicy.
+	Log types below "log_level" are skipped, see LogTypes.levels
+
+	Every segment has a sparse index, see io_handles.LogIndexFileFormat,
+	so Logger.query only reads the parts of a segment it needs. An active
+	segment from before segments were kept isn't rotated, compressing it
+	all at once would stall saving, it's archived by archive_legacy
+	(--convert-logs) instead
+	"""
+
+	SAVE_BATCH_SIZE = 256
+	PRINT_BATCH_SIZE = 64
+	DEFAULT_QUEUE_SIZE = 4096
+	DEFAULT_OVERFLOW_POLICY = OverflowPolicy.DropDebugFirst
+	DEFAULT_LEVEL = LogTypes.Debug
+	DEFAULT_MAX_SEGMENT_SIZE = 1048576 # 1 MiB
+	DEFAULT_MAX_SEGMENT_AGE = 86400 # 1 day
+	RETRY_DELAY = 1.0 # Seconds a thread waits after failing to save or print a batch
 
 	__instance = None
 
 	@classmethod
 	def get_logger(cls) -> "Logger":
 		if cls.__instance is None:
-			init(True)
-			cls.__instance = cls.__new__(cls)
-			self = cls.__instance
+			try: # Read before the logger is published, so a log while reading can't get a half built logger
+				binary = Logger.uses_binary()
+				queue_size = installer.get_config_int("log_queue_size", Logger.DEFAULT_QUEUE_SIZE)
+				overflow_policy = installer.get_config_value("log_overflow_policy", Logger.DEFAULT_OVERFLOW_POLICY)
+				level = installer.get_config_value("log_level", Logger.DEFAULT_LEVEL)
+			except (io_handles.FileDecodeError, ValueError): # Unreadable config
+				binary, queue_size, overflow_policy, level = False, Logger.DEFAULT_QUEUE_SIZE, Logger.DEFAULT_OVERFLOW_POLICY, Logger.DEFAULT_LEVEL
+
+			self = cls.__new__(cls)
 
 			self.__dead = False
+			self.fsync = False
+
+			self.binary = binary
+			self.log_format = Logger.get_format(self.binary)
+			self.log_file = io_handles.EasyFile(Logger.active_path(self.binary), True)
+			self.__log_data = None
+			self.manifest_file = io_handles.EasyFile(io_handles.FileUtil.root() + "/logs/manifest.homesec", True, atomic = True)
+			self.index_file = io_handles.EasyFile(Logger.index_path(), True)
+
+			self.max_segment_size = Logger.DEFAULT_MAX_SEGMENT_SIZE
+			self.max_segment_age = Logger.DEFAULT_MAX_SEGMENT_AGE
+			self.compression = io_handles.LogCompression.LZMA
 
-			self.log_file = io_handles.EasyFile(io_handles.FileUtil.root() + "/logs/log.homesec", True)
-			self.log_data = io_handles.LogFileFormat().from_file(self.log_file)
+			self.__segment_size = getsize(self.log_file.filepath)
+			self.__index_bucket = None # Bucket of the last index record, a repeated bucket record is harmless
+			self.__segment_start = None # Epoch of the active segment's first entry, read when first needed
+			self.__legacy = False # Active segment is from before segments were kept
+			self.__lock = RLock()
 
-			self.__save_queue  = Queue()
-			self.__print_queue = Queue()
-			self.__save_thread = thread.EasyThread(self.__save, True)
-			self.__print_thread = thread.EasyThread(self.__print, True)
-			self.__save_thread.start()
-			self.__print_thread.start()
+			self.level = LogTypes.levels[level.lower() if LogTypes.is_valid_type(level) else Logger.DEFAULT_LEVEL]
+
+			self.__save_queue  = LogQueue(queue_size, overflow_policy)
+			self.__print_queue = LogQueue(queue_size, overflow_policy)
+			self.__save_thread = None
+			self.__print_thread = None
+
+			cls.__instance = self
 
 		if cls.__instance.__dead:
 			dead = type("Dead Logger", (object,), {})
-			dead.log_file = dead.log_data = dead.__save_queue = dead.__print_queue = dead.__save_thread = dead.__print_thread = dead.__dead = None
-			dead.save = dead.print = dead.finalize = dead.get = dead.__save = dead.__print = lambda *args, **kwargs: None
+			dead.binary = dead.log_format = dead.log_file = dead.log_data = dead.manifest_file = dead.index_file = dead.max_segment_size = dead.max_segment_age = dead.compression = dead.fsync = dead.level = dead.__save_queue = dead.__print_queue = dead.__save_thread = dead.__print_thread = dead.__dead = None
+			dead.metrics = {}
+			dead.is_enabled = lambda *args, **kwargs: False
+			dead.save = dead.print = dead.finalize = dead.get = dead.rotate = dead.archive_legacy = dead.__save = dead.__print = lambda *args, **kwargs: None
 			return dead
 
 		return cls.__instance
 
 	def __init__(self):
 		# For typing
+		self.binary: bool
+		self.log_format: Union[io_handles.LogFileFormat, io_handles.BinaryLogFileFormat]
 		self.log_file: io_handles.EasyFile
-		self.log_data: io_handles.LogFileData
+		self.manifest_file: io_handles.EasyFile
+		self.index_file: io_handles.EasyFile
+		self.max_segment_size: int
+		self.max_segment_age: int
+		self.compression: int
+		self.fsync: bool
+		self.level: int
 
 		self.__dead: bool
-		self.__save_queue: Queue[LogData]
-		self.__print_queue: Queue[LogData]
+		self.__segment_size: int
+		self.__index_bucket: Union[int, None]
+		self.__segment_start: Union[int, None]
+		self.__legacy: bool
+		self.__log_data: Union[io_handles.LogFileData, None]
+		self.__lock: RLock
+		self.__save_queue: LogQueue
+		self.__print_queue: LogQueue
 		self.__save_thread: thread.EasyThread
 		self.__print_thread: thread.EasyThread
 
 		raise RuntimeError("Get logger from Logger.get_logger()")
 
-	def save(self, log: LogData) -> None:
+	@property
+	def log_data(self) -> io_handles.LogFileData:
+		"""
+		Every entry in the active segment, read from the file on first use
+		"""
+		with self.__lock:
+			if self.__log_data is None:
+				self.__log_data = self.log_format.from_file(self.log_file)
+
+			return self.__log_data
+
+	def is_enabled(self, logtype: str) -> bool:
+		return LogTypes.levels.get(logtype.lower(), 1) >= self.level
+
+	def save(self, log: Union[LogData, PendingLog]) -> None:
 		if not self.__dead:
-			if isinstance(log, LogData):
-				self.__save_queue.put_nowait(log)
+			if isinstance(log, (LogData, PendingLog)):
+				if self.__save_thread is None:
+					with self.__lock:
+						if self.__save_thread is None:
+							self.__legacy = bool(self.__segment_size) and not io_handles.LogIndexFileFormat().from_file(self.index_file).covers_start()
+
+							self.log_file.hold() # Appended to by every batch
+							self.index_file.hold()
+							self.__save_thread = thread.EasyThread(self.__save, True)
+							self.__save_thread.start()
 
-	def print(self, log: LogData) -> None:
+							if self.__legacy:
+								self.__save_queue.put(PendingLog(LogTypes.Warn, "The active log is from before logs were archived, run with --convert-logs to archive it"))
+
+				self.__save_queue.put(log)
+
+	def print(self, log: Union[LogData, PendingLog]) -> None:
 		if not self.__dead:
-			if isinstance(log, LogData):
-				self.__print_queue.put_nowait(log)
+			if isinstance(log, (LogData, PendingLog)):
+				if self.__print_thread is None:
+					with self.__lock:
+						if self.__print_thread is None:
+							init(True)
+							self.__print_thread = thread.EasyThread(self.__print, True)
+							self.__print_thread.start()
+
+				self.__print_queue.put(log)
 
 	def finalize(self) -> None:
 		if self.__dead: return
@@ -163,6 +466,9 @@ class Logger:
 			self.__save_thread.kill()
 			self.__save_queue = None
 
+		self.log_file.close()
+		self.index_file.close()
+
 		if self.__print_thread is not None:
 			if not self.__print_queue.empty():
 				self.__print(True)
@@ -170,54 +476,352 @@ class Logger:
 			self.__print_thread.kill()
 			self.__print_queue = None
 
+	@property
+	def metrics(self) -> Dict[str, int]:
+		"""
+		Queue depths and how many logs each queue has dropped
+		"""
+		return {
+			"save_queued": 0 if self.__save_queue is None else len(self.__save_queue),
+			"save_dropped": 0 if self.__save_queue is None else self.__save_queue.dropped,
+			"print_queued": 0 if self.__print_queue is None else len(self.__print_queue),
+			"print_dropped": 0 if self.__print_queue is None else self.__print_queue.dropped
+		}
+
 	def get(self, count: int) -> List[LogData]:
 		if isinstance(count, int):
-			return self.log_data.get_tail(count)
+			logs = self.log_data.get_tail(count)
 
-	def __save(self, final: bool = False) -> None:
-		if final:
-			while not self.__save_queue.empty():
-				self.log_data.add_log(self.__save_queue.get())
+			if len(logs) < count: # Active segment is too short, pull from the newest archived segments
+				for segment in reversed(io_handles.LogManifestFileFormat().from_file(self.manifest_file).segments):
+					logs = self.read_segment(segment).get_tail(count - len(logs)) + logs
+
+					if len(logs) >= count:
+						break
+
+			return logs
+
+	@staticmethod
+	def read_segment(segment: io_handles.LogSegment) -> io_handles.LogFileData:
+		segment_file = io_handles.EasyFile(Logger.segment_path(segment.number))
+
+		def read(stream: BinaryIO):
+			return stream.read()
+
+		return Logger.get_format(segment.binary).from_bytes(io_handles.LogCompression.decompress(segment.compression, segment_file.get_stream("read", read)))
+
+	@staticmethod
+	def segment_path(number: int) -> str:
+		return io_handles.FileUtil.root() + f"/logs/log.{number}.homesec"
+
+	@staticmethod
+	def index_path(number: int = None) -> str:
+		"""
+		Path of a segment's index, the active segment's if number is None
+		"""
+		return io_handles.FileUtil.root() + ("/logs/log.index.homesec" if number is None else f"/logs/log.{number}.index.homesec")
+
+	@staticmethod
+	def active_path(binary: bool) -> str:
+		return io_handles.FileUtil.root() + ("/logs/log.bin.homesec" if binary else "/logs/log.homesec")
+
+	@staticmethod
+	def get_format(binary: bool) -> Union[io_handles.LogFileFormat, io_handles.BinaryLogFileFormat]:
+		return io_handles.BinaryLogFileFormat() if binary else io_handles.LogFileFormat()
 
-			io_handles.LogFileFormat().save_to(self.log_file, self.log_data)
-			return
+	@staticmethod
+	def uses_binary() -> bool:
+		return installer.get_config_value("log_format", "text") == "binary"
 
-		self.log_data.add_log(self.__save_queue.get())
-		io_handles.LogFileFormat().save_to(self.log_file, self.log_data)
+	@staticmethod
+	def convert_to_binary() -> int:
 		"""
-		if not self.__save_queue.empty():
-			while not self.__save_queue.empty():
-				self.log_data.add_log(self.__save_queue.get())
+		Converts the active text log into the binary format and switches
+		the logger to binary, returns how many entries were converted
 
-			io_handles.LogFileFormat().save_to(self.log_file, self.log_data)
+		Refuses to run without an installation, so no config is created,
+		or when there's both a text and a binary active log
 		"""
+		if not io_handles.FileUtil.does_file_exist(installer.get_config_path()):
+			raise FileNotFoundError("HomeSec isn't installed, there's no config to switch the log format in")
 
-	def __print(self, final: bool = False) -> None:
-		if final:
-			while not self.__print_queue.empty():
-				message = self.__print_queue.get()
-				if sys.stdout.writable and not sys.stdout.closed:
-					sys.stdout.write(f"{message}\n")
+		text_path = Logger.active_path(False)
+		if io_handles.FileUtil.does_file_exist(text_path) and io_handles.FileUtil.does_file_exist(Logger.active_path(True)):
+			raise FileExistsError("There's already a binary log, converting the text log would overwrite it")
 
-			sys.stdout.flush()
-			return
+		if not io_handles.FileUtil.does_file_exist(text_path):
+			converted = 0
+		else:
+			converted = io_handles.BinaryLogFileFormat().convert_from_text(io_handles.EasyFile(text_path), io_handles.EasyFile(Logger.active_path(True), True))
+			io_handles.FileUtil.delete_file(text_path)
+			Logger.rebuild_index(True) # Offsets were into the text log
 
-		message = self.__print_queue.get()
-		if sys.stdout.writable and not sys.stdout.closed:
-			sys.stdout.write(f"{message}\n")
-			sys.stdout.flush()
+		installer.set_config_value("log_format", "binary")
+		return converted
 
+	@staticmethod
+	def tail(count: int) -> List[LogData]:
+		"""
+		Reads the last count entries without starting the logger, the
+		active segment is read backwards from its end so only the blocks
+		holding those entries are read
 		"""
-		if not self.__print_queue.empty():
-			flush = False
-			while not self.__print_queue.empty():
-				message = self.__print_queue.get()
-				if sys.stdout.writable and not sys.stdout.closed:
-					flush = True
-					sys.stdout.write(f"{message}\n")
+		root = io_handles.FileUtil.root()
+		binary = Logger.uses_binary()
+		if not isinstance(count, int) or count <= 0 or not io_handles.FileUtil.does_file_exist(Logger.active_path(binary)):
+			return []
 
-			if flush:
-				sys.stdout.flush()
+		logs = Logger.get_format(binary).tail(io_handles.EasyFile(Logger.active_path(binary)), count)
+
+		if len(logs) < count and io_handles.FileUtil.does_file_exist(root + "/logs/manifest.homesec"):
+			for segment in reversed(io_handles.LogManifestFileFormat().from_file(io_handles.EasyFile(root + "/logs/manifest.homesec")).segments):
+				logs = Logger.read_segment(segment).get_tail(count - len(logs)) + logs
+
+				if len(logs) >= count:
+					break
+
+		return logs
+
+	@staticmethod
+	def query(logtype: str = None, since: int = None, until: int = None, grep: str = None, count: int = None) -> List[LogData]:
 		"""
+		Finds entries of a log type, between two epochs (inclusive) and
+		containing a substring without starting the logger, any filter
+		left as None matches everything. Returns the last count matches,
+		or all of them if count is None
+
+		Archived segments outside the time range are skipped, the rest
+		are read from the first index bucket that could hold since or
+		only at the indexed offsets of logtype
+		"""
+		root = io_handles.FileUtil.root()
+		binary = Logger.uses_binary()
+		type_id = None if logtype is None else LogTypes.type_ids[logtype.lower()]
+		logs: List[LogData] = []
+
+		if io_handles.FileUtil.does_file_exist(root + "/logs/manifest.homesec"):
+			for segment in io_handles.LogManifestFileFormat().from_file(io_handles.EasyFile(root + "/logs/manifest.homesec")).segments:
+				if (since is not None and segment.end < since) or (until is not None and segment.start > until):
+					continue
+
+				segment_file = io_handles.EasyFile(Logger.segment_path(segment.number))
+
+				def read(stream: BinaryIO):
+					if segment.compression != io_handles.LogCompression.NONE:
+						stream = BytesIO(io_handles.LogCompression.decompress(segment.compression, stream.read()))
+
+					return Logger.__query_stream(stream, Logger.get_format(segment.binary), Logger.__read_index(segment.number), type_id, since, until, grep)
+
+				logs += segment_file.get_stream("read", read)
+
+		if io_handles.FileUtil.does_file_exist(Logger.active_path(binary)):
+			def read_active(stream: BinaryIO):
+				return Logger.__query_stream(stream, Logger.get_format(binary), Logger.__read_index(), type_id, since, until, grep)
+
+			logs += io_handles.EasyFile(Logger.active_path(binary)).get_stream("read", read_active)
+
+		return logs if count is None else logs[max(len(logs) - count, 0):]
+
+	@staticmethod
+	def __read_index(number: int = None) -> Union[io_handles.LogIndexFileData, None]:
+		path = Logger.index_path(number)
+		if not io_handles.FileUtil.does_file_exist(path):
+			return None # Segments from before indexes were kept are scanned
+
+		index = io_handles.LogIndexFileFormat().from_file(io_handles.EasyFile(path))
+		return index if index.covers_start() else None # Started part way through the segment, so it's scanned
+
+	@staticmethod
+	def rebuild_index(binary: bool) -> Tuple[int, Union[int, None]]:
+		"""
+		Rewrites the active segment's index from its entries, returns how
+		many entries were indexed and the newest bucket
+		"""
+		log_format = Logger.get_format(binary)
+
+		def read(stream: BinaryIO):
+			logs: List[LogData] = []
+			offsets: List[int] = []
+			entries = log_format.iter_logs(stream)
+
+			try:
+				while True:
+					offset = stream.tell() # At or before the entry, skipped lines are skipped again when it's read
+					log = next(entries, None)
+					if log is None:
+						return logs, offsets
+
+					logs.append(log)
+					offsets.append(offset)
+			except io_handles.FileDecodeError: # Entry cut off by a crash
+				return logs, offsets
+
+		logs, offsets = io_handles.EasyFile(Logger.active_path(binary), True).get_stream("read", read)
+		records, bucket = io_handles.LogIndexFileFormat().records_for(logs, offsets)
+
+		def write(stream: BinaryIO):
+			stream.write(records)
+
+		io_handles.EasyFile(Logger.index_path(), True, atomic = True).get_stream("write", write)
+		return len(logs), bucket
+
+	@staticmethod
+	def __query_stream(stream: BinaryIO, log_format: Union[io_handles.LogFileFormat, io_handles.BinaryLogFileFormat], \
+		index: Union[io_handles.LogIndexFileData, None], type_id: int, since: int, until: int, grep: str) -> List[LogData]:
+		logs: List[LogData] = []
+
+		def matches(log: LogData) -> bool:
+			epoch = log.timestamp.epoch
+			return (since is None or epoch >= since) and (until is None or epoch <= until) \
+				and (type_id is None or LogTypes.type_ids.get(log.logtype.lower()) == type_id) \
+				and (grep is None or grep in log.unsafe_message)
+
+		if index is not None and type_id is not None:
+			for offset in index.type_offsets(type_id, since, until):
+				stream.seek(offset)
+				log = next(log_format.iter_logs(stream), None)
+
+				if log is not None and matches(log):
+					logs.append(log)
+
+			return logs
+
+		offset = 0 if index is None else index.start_offset(since)
+		if offset is None:
+			return logs
+
+		stream.seek(offset)
+		for log in log_format.iter_logs(stream):
+			if until is not None and log.timestamp.epoch > until:
+				break # Entries are appended in time order
+
+			if matches(log):
+				logs.append(log)
+
+		return logs
+
+	def rotate(self) -> None:
+		"""
+		Archives the active segment and starts a new one
+		"""
+		with self.__lock:
+			self.__rotate()
+
+	def archive_legacy(self) -> int:
+		"""
+		Indexes and archives an active segment from before segments were
+		kept, returns how many entries were archived
+		"""
+		with self.__lock:
+			if not self.__segment_size or io_handles.LogIndexFileFormat().from_file(self.index_file).covers_start():
+				return 0
+
+			count = Logger.rebuild_index(self.binary)[0]
+			self.__rotate()
+			return count
+
+	def __rotate(self) -> None:
+		if not self.__segment_size: return
+
+		def read(stream: BinaryIO):
+			return stream.read()
+
+		def write(stream: BinaryIO):
+			stream.write(b"")
+
+		raw = self.log_file.get_stream("read", read)
+		logs = self.log_format.from_bytes(raw).logs if self.__log_data is None else self.__log_data.logs
+		if not len(logs): return
+
+		manifest = io_handles.LogManifestFileFormat().from_file(self.manifest_file)
+		segment = io_handles.LogSegment(manifest.next_number, logs[0].timestamp.epoch, \
+			logs[-1].timestamp.epoch, len(logs), self.compression, self.binary)
+
+		compressed = io_handles.LogCompression.compress(segment.compression, raw)
+
+		def write_segment(stream: BinaryIO):
+			stream.write(compressed)
+
+		io_handles.EasyFile(self.segment_path(segment.number), True, atomic = True).get_stream("write", write_segment)
+
+		held = self.index_file.held
+		self.index_file.close()
+
+		if self.index_file.exists:
+			replace(self.index_file.filepath, self.index_path(segment.number))
+
+		self.index_file = io_handles.EasyFile(self.index_path(), True)
+		if held:
+			self.index_file.hold()
+		self.__index_bucket = None
+
+		manifest.segments.append(segment)
+		io_handles.LogManifestFileFormat().save_to(self.manifest_file, manifest)
+
+		self.log_file.get_stream("write", write)
+		self.__log_data = None if self.__log_data is None else io_handles.LogFileData()
+		self.__segment_size = 0
+		self.__segment_start = None
+		self.__legacy = False
+
+	def __should_rotate(self) -> bool:
+		if not self.__segment_size or self.__legacy: return False
+
+		if self.__segment_start is None:
+			def read(stream: BinaryIO):
+				return next(self.log_format.iter_logs(stream), None)
+
+			first = self.log_file.get_stream("read", read)
+			if first is None: return False
+
+			self.__segment_start = first.timestamp.epoch
+
+		return self.__segment_size >= self.max_segment_size or time() - self.__segment_start >= self.max_segment_age
+
+	def __save(self, final: bool = False) -> None:
+		if final:
+			batch = self.__save_queue.get_batch(len(self.__save_queue), 0)
+		else:
+			batch = self.__save_queue.get_batch(Logger.SAVE_BATCH_SIZE, 1) # Times out so the thread can be killed
+
+		if not len(batch): return
+
+		try:
+			batch = [log.render() if isinstance(log, PendingLog) else log for log in batch]
+
+			with self.__lock:
+				if self.__log_data is not None:
+					for log in batch:
+						self.__log_data.add_log(log)
+
+				offsets = self.log_format.append_to(self.log_file, batch, self.fsync)
+				records, self.__index_bucket = io_handles.LogIndexFileFormat().records_for(batch, offsets, self.__index_bucket)
+				io_handles.LogIndexFileFormat().append_to(self.index_file, records)
+				self.__segment_size = getsize(self.log_file.filepath)
+
+				if self.__should_rotate():
+					self.__rotate()
+
+		except Exception as e: # Keeps the save thread alive, Log() callers blocked on a full queue would otherwise wait forever
+			failure.notice(failure.Threading.Exception_Raised, f"Failed to save {len(batch)} logs", True, e)
+
+			if not final:
+				sleep(Logger.RETRY_DELAY) # The notice is saved next, so don't spin on a failing disk
+
+	def __print(self, final: bool = False) -> None:
+		if final:
+			batch = self.__print_queue.get_batch(len(self.__print_queue), 0)
+		else:
+			batch = self.__print_queue.get_batch(Logger.PRINT_BATCH_SIZE, 1)
+
+		if len(batch) and sys.stdout.writable and not sys.stdout.closed:
+			try:
+				sys.stdout.write("".join([f"{message}\n" for message in batch]))
+				sys.stdout.flush()
+			except Exception as e: # Keeps the print thread alive, the notice is only saved as printing is what failed
+				failure.notice(failure.Threading.Exception_Raised, f"Failed to print {len(batch)} logs", False, e)
+
+				if not final:
+					sleep(Logger.RETRY_DELAY)
 
-import thread, io_handles
\ No newline at end of file
+import thread, io_handles, installer, failure
\ No newline at end of file
@@ -1 +1 @@
-__all__ = [ "net_io_handles", "packet", "protocol", "protocols", "sessions" ]
\ No newline at end of file
+__all__ = [ "codec", "net_io_handles", "packet", "protocol", "protocols", "sessions" ]
\ No newline at end of file
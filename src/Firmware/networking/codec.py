@@ -0,0 +1,57 @@
+from struct import Struct
+from typing import Tuple, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+UINT8  = Struct(">B")
+UINT16 = Struct(">H")
+UINT32 = Struct(">I")
+
+# Flag byte followed by the 3 byte packet length, packed as one big endian integer
+FLAG_LENGTH = Struct(">I")
+
+# Device version, protocol id, payload length
+UNENCRYPTED_HEADER = Struct(">3sBH")
+
+# Device version, protocol id length (always 2), protocol id, step, session id,
+# nonce, mac tag, previous random, next random, payload length
+ENCRYPTED_HEADER = Struct(">3sBHH32s16s16s32s32sH")
+
+# Session file (v2) expires, step, past random, present random, future random
+SESSION_HOT_FIELDS = Struct(">IH32s32s32s")
+
+# Log manifest segment number, first entry epoch, last entry epoch, entry count, compression, binary
+LOG_SEGMENT = Struct(">IIIIBB")
+
+# Binary log record message length, epoch, log type
+LOG_RECORD_HEADER = Struct(">IqB")
+
+# Log index record kind (log type or bucket marker), epoch, offset into the segment
+LOG_INDEX_RECORD = Struct(">BqQ")
+
+MAX_FRAME_LENGTH = 0xFFFFFF
+
+def decode_uint(data: Buffer) -> int:
+	"""
+	Decodes a big endian unsigned integer of any width
+	"""
+	return int.from_bytes(data, "big")
+
+def encode_uint(value: int) -> bytes:
+	"""
+	Encodes an unsigned integer with as few bytes as possible, 0 is encoded as no bytes
+	"""
+	if value <= 0:
+		return b""
+
+	return value.to_bytes((value.bit_length() + 7) // 8, "big")
+
+def encode_flag_length(flag: int, length: int) -> bytes:
+	if length > MAX_FRAME_LENGTH:
+		raise ValueError("Data is too long such that it's length cannot be saved in only 3 bytes")
+
+	return FLAG_LENGTH.pack(flag << 24 | length)
+
+def decode_flag_length(data: Buffer, offset: int = 0) -> Tuple[int, int]:
+	value = FLAG_LENGTH.unpack_from(data, offset)[0]
+	return value >> 24, value & MAX_FRAME_LENGTH
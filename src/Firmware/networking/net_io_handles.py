@@ -1,7 +1,7 @@
 from __future__ import annotations
 
 import bluetooth
-from typing import Callable, List, Dict
+from typing import Callable, List, Dict, Tuple
 
 class ServiceIDs:
 
@@ -10,20 +10,56 @@ class ServiceIDs:
 
 class Connection:
 
+	RECV_BUFFER_SIZE = 131072 # Room for two maximum size packets per recv
+
 	def __init__(self, bt_sock: bluetooth.BluetoothSocket, recv_callback: Callable[["Connection", bytes], bool], disconnect_callback: Callable[["Connection"], None]):
 		self.bt_sock = bt_sock
 		self.mac: str = bt_sock._sock.getpeername()[0].upper()
+		self.framer = packet.PacketFramer()
 		self.listen_thread = thread.EasyThread(self.__internal_init, True, recv_callback)
 		self.listen_thread.start()
 		self.disconnect_callback = disconnect_callback
 
 		self.active_unencrypted_protocol: protocol.Protocol = None
 		self.active_encrypted_protocol: protocol.Protocol = None
-		self.session: sessions.Session = None
+		self.__session: sessions.Session = None
+		self.peer_version: Tuple[int, int, int] = None
 
 	def __del__(self):
 		if self.session is not None:
 			self.session.save()
+			self.session = None
+
+	@property
+	def session(self) -> "sessions.Session":
+		return self.__session
+
+	@session.setter
+	def session(self, session: "sessions.Session"):
+		"""
+		Sessions in use by a connection are pinned so the session manager
+		never evicts them
+		"""
+		if session is self.__session: return
+
+		if self.__session is not None:
+			sessions.SessionManager.get_manager().unpin(self.__session)
+
+		if session is not None:
+			sessions.SessionManager.get_manager().pin(session)
+
+		self.__session = session
+
+	@property
+	def signature_mode(self) -> int:
+		"""
+		Signing mode for encrypted packets sent on this connection,
+		the MAC mode needs a shared AES key and both devices to support it
+		"""
+		if self.session is None or self.session.shared_aes is None:
+			return packet.SignatureMode.RSA
+
+		return packet.SignatureMode.negotiate(installer.get_version_tuple(), self.peer_version)
 
 	@property
 	def closed(self):
@@ -47,36 +83,25 @@ class Connection:
 			raise thread.EasyThreadClose("Internal bluetooth socket has been closed")
 
 		try:
-			is_encrypted = self.bt_sock.recv(1)
-
-			if len(is_encrypted) == 1:
-				length_bytes = self.bt_sock.recv(3)
+			data = self.bt_sock.recv(Connection.RECV_BUFFER_SIZE)
 
-				if len(length_bytes) == 3:
-					packet_length = packet.from_base256(length_bytes)
-
-					if is_encrypted[0] == 0:
-						if packet_length > 65544:
-							raise thread.EasyThreadClose(f"Terminated recv thread due to bad unencrypted packet")
-
-					elif is_encrypted[0] == 1:
-						if packet_length > 66441:
-							raise thread.EasyThreadClose(f"Terminated recv thread due to bad encrypted packet")
-
-					else:
-						raise thread.EasyThreadClose(f"Terminated recv thread due to bad flag bit ({is_encrypted[0]})")
-
-					data: bytes = self.bt_sock.recv(packet_length)
+			if data:
+				try:
+					frames = self.framer.feed(data)
+				except ValueError as e:
+					self.close()
+					self.disconnect_callback(self)
+					raise thread.EasyThreadClose(f"Terminated recv thread due to bad packet ({e})")
 
-					if len(data) == packet_length + 3:
-						data = is_encrypted + length_bytes + data
+				for frame in frames:
+					callback_return = callback(self, frame)
+					if callback_return: continue
 
-						callback_return = callback(self, data)
-						if callback_return: return
+					self.close()
+					self.disconnect_callback(self)
+					raise thread.EasyThreadClose(f"Terminated recv thread due to callback returning {callback_return}")
 
-						self.close()
-						self.disconnect_callback(self)
-						raise thread.EasyThreadClose(f"Terminated recv thread due to callback returning {callback_return}")
+				return
 
 			self.close()
 			self.disconnect_callback(self)
@@ -202,6 +227,8 @@ class Server:
 
 		print(f"Received {packet_data}")
 
+		client.peer_version = packet_data.device_version
+
 		# See if we know the protocol
 		proto_manager = protocol.ProtocolManager.get_manager()
 		if proto_manager.is_registered_protocol(packet_data.protocol_id):
@@ -228,11 +255,21 @@ class Server:
 					client.send(packet.build_unencrypted_packet(b"New session needed", 16))
 					return True
 
-				if type(client.session.client_rsa_public) != bytes:
-					client.send(packet.build_unencrypted_packet(b"Cannot verify signature, no public key", 16))
-					return True
+				if packet_data.signature_mode == packet.SignatureMode.MAC:
+					if not packet.SignatureMode.supports_mac(installer.get_version_tuple()):
+						client.send(packet.build_unencrypted_packet(b"Cannot verify signature, unsupported signature mode", 16))
+						return True
+
+					verifier = encryption.EasyMAC.from_shared_aes(client.session.shared_aes, "client") # Server only verifies packets the client sent
 
-				if not encryption.EasyRSA(client.session.client_rsa_public).verify(data[1:-512], packet_data.signature):
+				else:
+					if type(client.session.client_rsa_public) != bytes:
+						client.send(packet.build_unencrypted_packet(b"Cannot verify signature, no public key", 16))
+						return True
+
+					verifier = encryption.RSAKeyCache.get_cache().get(client.session.id, client.session.client_rsa_public, client.session.expires)
+
+				if not verifier.verify(data[1:-len(packet_data.signature)], packet_data.signature):
 					client.send(packet.build_unencrypted_packet(b"Cannot verify signature, data didn't match signature", 16))
 					return True
 
@@ -251,21 +288,23 @@ class Server:
 					client.send(packet.build_unencrypted_packet(b"Couldn't decrypt payload", 16))
 					return True
 
-				if packet_data.previous_random != client.session.future_random: # If false, everything is working as intended
-					if packet_data.previous_random != client.session.past_random: # If false, a packet was dropped
-						client.send(packet.build_unencrypted_packet(b"Previous random isn't correct", 16))
+				with client.session.internal_lock:
+					if packet_data.previous_random != client.session.future_random: # If false, everything is working as intended
+						if packet_data.previous_random != client.session.past_random: # If false, a packet was dropped
+							client.send(packet.build_unencrypted_packet(b"Previous random isn't correct", 16))
+							return True
+						else: # The last sent packet was dropped
+							# The below line subtracks one from the session step [(step - 1 + 65536) mod 65536], prevents negatives
+							client.session.step = (client.session.step + 65535) % 65536 # Roll back step as we dropped a packet and the step check will fail
+
+					if packet_data.step != (client.session.step + 1) % 65536:
+						client.send(packet.build_unencrypted_packet(b"Step isn't correct", 16))
 						return True
-					else: # The last sent packet was dropped
-						# The below line subtracks one from the session step [(step - 1 + 65536) mod 65536], prevents negatives
-						client.session.step = (client.session.step + 65535) % 65536 # Roll back step as we dropped a packet and the step check will fail
 
-				if packet_data.step != (client.session.step + 1) % 65536:
-					client.send(packet.build_unencrypted_packet(b"Step isn't correct", 16))
-					return True
+					client.session.step = packet_data.step # Save the step we've just received
+					client.session.present_random = packet_data.next_random
 
-				client.session.step = packet_data.step # Save the step we've just received
-				client.session.present_random = packet_data.next_random
-				client.session.save()
+				client.session.mark_dirty()
 
 				packet_data.payload = decrypted_payload
 
@@ -334,14 +373,14 @@ class Server:
 
 						data = client.active_encrypted_protocol.sending_data()
 						if isinstance(data, bytes) and len(data):
-							client.send(packet.build_encrypted_packet_with_aes(data, packet_data.protocol_id, client.session, "server"))
+							client.send(packet.build_encrypted_packet_with_aes(data, packet_data.protocol_id, client.session, "server", client.signature_mode))
 
 				elif client.active_encrypted_protocol.protocol_id == packet_data.protocol_id:
 					client.active_encrypted_protocol.received_data(packet_data.payload)
 
 					data = client.active_encrypted_protocol.sending_data()
 					if isinstance(data, bytes) and len(data):
-						client.send(packet.build_encrypted_packet_with_aes(data, packet_data.protocol_id, client.session, "server"))
+						client.send(packet.build_encrypted_packet_with_aes(data, packet_data.protocol_id, client.session, "server", client.signature_mode))
 
 		else:
 			print("We don't know protocol", packet_data.protocol_id)
@@ -354,5 +393,5 @@ class Server:
 		if client.mac in self.clients:
 			del self.clients[client.mac]
 
-import thread, encryption
+import thread, encryption, installer
 from networking import packet, sessions, protocol
\ No newline at end of file
@@ -1,6 +1,51 @@
 import secrets
-from struct import pack
-from typing import NamedTuple, Tuple
+from typing import List, NamedTuple, Tuple
+
+MAX_UNENCRYPTED_PACKET_LENGTH = 65544 # Excluding the flag and length bytes
+MAX_ENCRYPTED_PACKET_LENGTH = 66441 # RSA signed
+MAX_MAC_ENCRYPTED_PACKET_LENGTH = 65961
+
+class SignatureMode:
+	"""
+	How an encrypted packet is signed, the value is the packet's flag byte
+
+	RSA is the legacy mode, a 512 byte RSA-4096 signature over SHA3-512.
+	MAC is a 32 byte HMAC-SHA3-256 keyed from the session's shared AES key,
+	it is only used when both devices are at least MAC_VERSION
+	"""
+
+	RSA = 1
+	MAC = 2
+
+	MAC_VERSION = (0, 0, 2)
+
+	signature_lengths = {
+		RSA: 512,
+		MAC: 32
+	}
+
+	max_packet_lengths = {
+		RSA: MAX_ENCRYPTED_PACKET_LENGTH,
+		MAC: MAX_MAC_ENCRYPTED_PACKET_LENGTH
+	}
+
+	@staticmethod
+	def is_valid_mode(mode: int) -> bool:
+		return mode in SignatureMode.signature_lengths
+
+	@staticmethod
+	def supports_mac(device_version: Tuple[int, int, int]) -> bool:
+		return tuple(device_version) >= SignatureMode.MAC_VERSION
+
+	@staticmethod
+	def negotiate(local_version: Tuple[int, int, int], peer_version: Tuple[int, int, int]) -> int:
+		"""
+		Picks the signing mode to use with a peer from both device versions
+		"""
+		if peer_version is not None and SignatureMode.supports_mac(local_version) and SignatureMode.supports_mac(peer_version):
+			return SignatureMode.MAC
+
+		return SignatureMode.RSA
 
 class PacketStructure(NamedTuple):
 	encrypted: bool
@@ -16,24 +61,13 @@ class PacketStructure(NamedTuple):
 	previous_random: bytes = None
 	next_random: bytes = None
 	signature: bytes = None
+	signature_mode: int = None
 
 def from_base256(data: bytes) -> int:
-	value = len(data) - 1
-	total = 0
-
-	for index in range(value, -1, -1):
-		total += 256 ** (value - index) * data[index]
-
-	return total
+	return codec.decode_uint(data)
 
 def to_base256(value: int) -> bytes:
-	values = []
-
-	while value > 0:
-		values.insert(0, value % 256)
-		value //= 256
-
-	return bytes(values)
+	return codec.encode_uint(value)
 
 def get_length_data(length: int, min_length: int = None, max_length: int = None) -> bytes:
 	length_bytes = to_base256(length)
@@ -61,15 +95,11 @@ def build_unencrypted_packet(payload: bytes, protocol_id: int) -> bytes:
 	if len(payload) > 65535:
 		raise ValueError("Invalid Payload, too long")
 
-	packet: bytes = installer.get_version_bytes()
+	header = codec.UNENCRYPTED_HEADER.pack(installer.get_version_bytes(), protocol_id, len(payload))
 
-	packet += to_base256(protocol_id)
+	return codec.encode_flag_length(0, len(header) + len(payload)) + header + payload # If ValueError raised, packet is too long
 
-	packet += add_length_data(payload, 2, 2) # No error should be raised
-
-	return bytes([0]) + add_length_data(packet, 3, 3) # If ValueError raised, packet is too long
-
-def build_encrypted_packet(payload: bytes, protocol_id: int, session: "sessions.Session", sender: str, nonce: bytes, mac_tag: bytes) -> bytes:
+def build_encrypted_packet(payload: bytes, protocol_id: int, session: "sessions.Session", sender: str, nonce: bytes, mac_tag: bytes, signature_mode: int = SignatureMode.RSA) -> bytes:
 	if protocol_id < 256 or protocol_id > 65535:
 		raise ValueError("Protocol ID must be between 256 and 65535, lower than 256 is unencrypted and higher isn't supported")
 
@@ -94,90 +124,89 @@ def build_encrypted_packet(payload: bytes, protocol_id: int, session: "sessions.
 	if sender not in ("server", "client"):
 		raise ValueError("Invalid Sender")
 
-	packet = installer.get_version_bytes()
-
-	packet += add_length_data(to_base256(protocol_id), 1, 1) # No error should be raised
-
-	packet += bytes([(session.step + 1) // 256 % 256, (session.step + 1) % 256])
-
-	packet += session.id
+	if not SignatureMode.is_valid_mode(signature_mode):
+		raise ValueError("Invalid Signature Mode")
 
-	packet += nonce
+	header = codec.ENCRYPTED_HEADER.pack(installer.get_version_bytes(), 2, protocol_id, (session.step + 1) % 65536, \
+		session.id, nonce, mac_tag, session.present_random, next_random, len(payload))
 
-	packet += mac_tag
+	signature_length = SignatureMode.signature_lengths[signature_mode]
+	packet = codec.encode_flag_length(signature_mode, len(header) + len(payload) + signature_length) + header + payload # Flag byte isn't signed
 
-	packet += session.present_random
+	if signature_mode == SignatureMode.MAC:
+		signer = encryption.EasyMAC.from_shared_aes(session.shared_aes, sender)
 
-	packet += next_random
-
-	packet += add_length_data(payload, 2, 2) # No error should be raised
-
-	packet = add_length_data(len(packet) + 512, 3, 3) + packet
+	else:
+		rsa_cache = encryption.RSAKeyCache.get_cache()
+		if sender == "server":
+			signer = rsa_cache.get(session.id, session.server_rsa_private, session.expires)
+		elif sender == "client":
+			signer = rsa_cache.get(session.id, session.client_rsa_private, session.expires)
 
-	if sender == "server":
-		rsa = encryption.EasyRSA(session.server_rsa_private)
-	elif sender == "client":
-		rsa = encryption.EasyRSA(session.client_rsa_private)
+	signature = signer.sign(packet[1:])
 
-	signature = rsa.sign(packet)
+	with session.internal_lock:
+		session.step = (session.step + 1) % 65536 # Save the step we've just sent, we'll expect plus 1 back
+		session.past_random = session.future_random
+		session.future_random = next_random
 
-	session.step = (session.step + 1) % 65536 # Save the step we've just sent, we'll expect plus 1 back
-	session.past_random = session.future_random
-	session.future_random = next_random
-	session.save()
+	session.mark_dirty()
 
-	return bytes([1]) + packet + signature # If ValueError raised, packet is too long
+	return packet + signature
 
-def build_encrypted_packet_with_aes(payload: bytes, protocol_id: int, session: "sessions.Session", sender: str) -> bytes:
+def build_encrypted_packet_with_aes(payload: bytes, protocol_id: int, session: "sessions.Session", sender: str, signature_mode: int = SignatureMode.RSA) -> bytes:
 	payload, mac_tag, nonce = encryption.EasyAES(session.shared_aes).encrypt(payload)
 
-	return build_encrypted_packet(payload, protocol_id, session, sender, nonce, mac_tag)
+	return build_encrypted_packet(payload, protocol_id, session, sender, nonce, mac_tag, signature_mode)
 
-def dissect_packet(packet: bytes) -> PacketStructure:
-	current_packet_length = len(packet)
+def dissect_packet(packet: bytes, materialize: bool = True) -> PacketStructure:
+	"""
+	Decodes a packet by walking a memoryview of it with fixed offsets
+	so the remaining data is never re-sliced (and copied) per field.
 
-	if not current_packet_length:
+	If materialize is False, the byte fields of the returned structure
+	are memoryviews into the original packet instead of bytes copies
+	"""
+	view = memoryview(packet)
+	end = len(view)
+
+	if not end:
 		raise ValueError("Empty packet")
 
-	is_encrypted = packet[0] == 1
-	packet = packet[1:]
-	current_packet_length -= 1
+	signature_mode = view[0] if SignatureMode.is_valid_mode(view[0]) else None
+	is_encrypted = signature_mode is not None
+	offset = 1
 
-	if current_packet_length < 3:
+	if end - offset < 3:
 		raise ValueError("Invalid End Of Packet")
 
-	packet_length = from_base256(packet[:3])
-	packet = packet[3:]
-	current_packet_length -= 3
+	packet_length = codec.decode_flag_length(view)[1]
+	offset += 3
 
-	if current_packet_length < 3:
+	if end - offset < 3:
 		raise ValueError("Invalid End Of Packet")
 
-	device_version = tuple(packet[:3])
-	packet = packet[3:]
-	current_packet_length -= 3
+	device_version = tuple(view[offset:offset + 3])
+	offset += 3
 
-	if current_packet_length < 2:
+	if end - offset < 2:
 		raise ValueError("Invalid End Of Packet")
 
 	if is_encrypted:
-		protocol_id_length = from_base256(packet[:1])
-		packet = packet[1:]
-		current_packet_length -= 1
+		protocol_id_length = view[offset]
+		offset += 1
 
-		if current_packet_length < protocol_id_length:
+		if end - offset < protocol_id_length:
 			raise ValueError("Invalid End Of Packet")
 
-		protocol_id = from_base256(packet[:protocol_id_length])
-		packet = packet[protocol_id_length:]
-		current_packet_length -= protocol_id_length
+		protocol_id = codec.decode_uint(view[offset:offset + protocol_id_length])
+		offset += protocol_id_length
 
 	else:
-		protocol_id = from_base256(packet[:1])
-		packet = packet[1:]
-		current_packet_length -= 1
+		protocol_id = view[offset]
+		offset += 1
 
-	if current_packet_length < 2:
+	if end - offset < 2:
 		raise ValueError("Invalid End Of Packet")
 
 	step = None
@@ -189,77 +218,133 @@ def dissect_packet(packet: bytes) -> PacketStructure:
 	signature = None
 
 	if is_encrypted:
-		if current_packet_length < 2:
+		# Step (2), session id (32), nonce (16), mac tag (16), previous random (32) and next random (32)
+		if end - offset < 2:
 			raise ValueError("Invalid End Of Packet")
 
-		step = from_base256(packet[:2])
-		packet = packet[2:]
-		current_packet_length -= 2
+		step = codec.UINT16.unpack_from(view, offset)[0]
+		offset += 2
 
-		if current_packet_length < 32:
+		if end - offset < 32:
 			raise ValueError("Invalid End Of Packet")
 
-		session_id = packet[:32]
-		packet = packet[32:]
-		current_packet_length -= 32
+		session_id = view[offset:offset + 32]
+		offset += 32
 
-		if current_packet_length < 16:
+		if end - offset < 16:
 			raise ValueError("Invalid End Of Packet")
 
-		nonce = packet[:16]
-		packet = packet[16:]
-		current_packet_length -= 16
+		nonce = view[offset:offset + 16]
+		offset += 16
 
-		if current_packet_length < 16:
+		if end - offset < 16:
 			raise ValueError("Invalid End Of Packet")
 
-		mac_tag = packet[:16]
-		packet = packet[16:]
-		current_packet_length -= 16
+		mac_tag = view[offset:offset + 16]
+		offset += 16
 
-		if current_packet_length < 32:
+		if end - offset < 32:
 			raise ValueError("Invalid End Of Packet")
 
-		previous_random = packet[:32]
-		packet = packet[32:]
-		current_packet_length -= 32
+		previous_random = view[offset:offset + 32]
+		offset += 32
 
-		if current_packet_length < 32:
+		if end - offset < 32:
 			raise ValueError("Invalid End Of Packet")
 
-		next_random = packet[:32]
-		packet = packet[32:]
-		current_packet_length -= 32
+		next_random = view[offset:offset + 32]
+		offset += 32
 
-	if current_packet_length < 2:
+	if end - offset < 2:
 		raise ValueError("Invalid End Of Packet")
 
-	payload_length = from_base256(packet[:2])
-	packet = packet[2:]
-	current_packet_length -= 2
+	payload_length = codec.UINT16.unpack_from(view, offset)[0]
+	offset += 2
 
-	if current_packet_length < payload_length:
+	if end - offset < payload_length:
 		raise ValueError("Invalid End Of Packet")
 
-	payload = packet[:payload_length]
-	packet = packet[payload_length:]
-	current_packet_length -= payload_length
+	payload = view[offset:offset + payload_length]
+	offset += payload_length
 
 	if is_encrypted:
-		if current_packet_length < 512:
+		signature_length = SignatureMode.signature_lengths[signature_mode]
+		if end - offset < signature_length:
 			raise ValueError("Invalid End Of Packet")
 
-		signature = packet[:512]
-		packet = packet[512:]
-		current_packet_length -= 512
+		signature = view[offset:offset + signature_length]
+		offset += signature_length
 
-	if len(packet):
+	if offset != end:
 		raise ValueError("Didn't reach End Of Packet")
 
-	return PacketStructure(is_encrypted, packet_length, device_version, protocol_id, payload, step, session_id, nonce, mac_tag, previous_random, next_random, signature)
+	if materialize:
+		payload = payload.tobytes()
+
+		if is_encrypted:
+			session_id = session_id.tobytes()
+			nonce = nonce.tobytes()
+			mac_tag = mac_tag.tobytes()
+			previous_random = previous_random.tobytes()
+			next_random = next_random.tobytes()
+			signature = signature.tobytes()
+
+	return PacketStructure(is_encrypted, packet_length, device_version, protocol_id, payload, step, session_id, nonce, mac_tag, previous_random, next_random, signature, signature_mode)
+
+class PacketFramer:
+	"""
+	Splits a stream of bytes into complete packets
+
+	Data can be fed in arbitrary chunks, partial packets are kept until
+	the rest of their bytes arrive and a single chunk may hold several
+	packets. Each frame returned includes its flag and length bytes.
+	"""
+
+	def __init__(self):
+		self.buffer = bytearray()
+
+	def feed(self, data: bytes) -> List[bytes]:
+		"""
+		Adds data to the framer and returns every packet that is now
+		complete. Raises ValueError if a packet header is invalid, the
+		framer shouldn't be used after that as the stream is desynced
+		"""
+		self.buffer += data
+		frames: List[bytes] = []
+		offset = 0
+		available = len(self.buffer)
+
+		while available - offset >= 4:
+			flag, packet_length = codec.decode_flag_length(self.buffer, offset)
+
+			if flag == 0:
+				if packet_length > MAX_UNENCRYPTED_PACKET_LENGTH:
+					raise ValueError("Unencrypted packet is too long")
+
+			elif SignatureMode.is_valid_mode(flag):
+				if packet_length > SignatureMode.max_packet_lengths[flag]:
+					raise ValueError("Encrypted packet is too long")
+
+			else:
+				raise ValueError(f"Invalid flag byte ({flag})")
+
+			frame_end = offset + 4 + packet_length
+			if frame_end > available:
+				break
+
+			frames.append(bytes(self.buffer[offset:frame_end]))
+			offset = frame_end
+
+		if offset:
+			del self.buffer[:offset]
+
+		return frames
+
+	@property
+	def pending(self) -> int: return len(self.buffer)
 
 import installer, encryption
-from networking import sessions
+from networking import codec, sessions
 
 def test():
 	pass # Make unit tests
\ No newline at end of file
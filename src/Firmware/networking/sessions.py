@@ -1,9 +1,49 @@
-from typing import Dict, List, NamedTuple, Union
+from typing import Dict, List, Tuple, Union
+from collections import OrderedDict
 from datetime import datetime, timezone
-from threading import RLock
-import secrets
+from threading import Event, RLock
+from time import monotonic
+from os import makedirs, replace, scandir
+from heapq import heappop, heappush
+import secrets, re, sqlite3
 
 class SessionManager:
+	"""
+	Keeps loaded sessions and writes changed sessions behind the packet
+	handling threads
+
+	Sessions marked dirty are flushed in a batch by a background thread
+	every flush_interval seconds, as soon as flush_threshold sessions are
+	dirty, and never later than max_unflushed_age seconds after a session
+	was first marked, each read from the config under the same name.
+	Everything left is flushed on shutdown.
+
+	Loaded sessions are kept in a min-heap by when they expire. A
+	background reaper destroys expired sessions in batches of
+	reap_batch_size at least every reap_interval seconds, and every
+	sweep_interval seconds asks the store for expired sessions that were
+	never loaded.
+
+	Sessions are kept by store, picked by "session_backend" in the
+	config, see SessionStore. Each flush is one save_many call. Stores
+	that can bulk load have as many unexpired sessions as fit in the
+	cache loaded on startup
+
+	Loaded sessions are cached least recently used first, capped by
+	"session_cache_size" sessions and "session_cache_bytes" estimated
+	bytes in the config. Evicted sessions are saved if dirty and loaded
+	again by get_session. Sessions pinned by a connection are never evicted
+	"""
+
+	DEFAULT_FLUSH_INTERVAL = 5.0
+	DEFAULT_FLUSH_THRESHOLD = 32
+	DEFAULT_MAX_UNFLUSHED_AGE = 10.0
+	DEFAULT_REAP_INTERVAL = 30.0
+	DEFAULT_REAP_BATCH_SIZE = 64
+	DEFAULT_SWEEP_INTERVAL = 3600.0
+	DEFAULT_CACHE_SIZE = 4096
+	DEFAULT_CACHE_BYTES = 32 * 1024 * 1024
+	SESSION_OVERHEAD = 512 # Rough bytes used by a session before its keys
 
 	__instance = None
 
@@ -15,25 +55,117 @@ class SessionManager:
 
 			self.__dead = False
 
-			self.sessions = {}
+			self.sessions = OrderedDict()
 			self.lock = RLock()
 			self.folder_path = io_handles.FileUtil.root() + "/data/sessions/"
 
+			self.store = SessionStore.from_config(self.folder_path)
+			self.expiry = []
+			self.__scheduled = {}
+			self.pinned = {}
+			self.dirty = {}
+			self.flushing = {}
+
+			self.cache_size = installer.get_config_int("session_cache_size", SessionManager.DEFAULT_CACHE_SIZE)
+			self.cache_bytes = installer.get_config_int("session_cache_bytes", SessionManager.DEFAULT_CACHE_BYTES)
+			self.__sizes = {}
+			self.__cached_bytes = 0
+			self.__hits = self.__misses = self.__evictions = 0
+
+			if self.store.bulk_load:
+				now = int(datetime.now(timezone.utc).timestamp())
+				loaded = []
+				loaded_bytes = 0
+
+				for id, session_data in self.store.load_all(now, self.cache_size).items(): # Longest lived first, stops once the byte cap is met
+					session = Session.from_data(id, session_data)
+					loaded_bytes += SessionManager.size_of(session)
+
+					if loaded_bytes > self.cache_bytes:
+						break
+
+					loaded.append(session)
+
+				for session in reversed(loaded): # Longest lived last, so it's evicted last
+					self.__cache(session)
+
+			self.flush_interval = installer.get_config_float("flush_interval", SessionManager.DEFAULT_FLUSH_INTERVAL)
+			self.flush_threshold = installer.get_config_int("flush_threshold", SessionManager.DEFAULT_FLUSH_THRESHOLD)
+			self.max_unflushed_age = installer.get_config_float("max_unflushed_age", SessionManager.DEFAULT_MAX_UNFLUSHED_AGE)
+
+			self.__flush_event = Event()
+			self.__flush_thread = None
+
+			self.reap_interval = SessionManager.DEFAULT_REAP_INTERVAL
+			self.reap_batch_size = SessionManager.DEFAULT_REAP_BATCH_SIZE
+			self.sweep_interval = SessionManager.DEFAULT_SWEEP_INTERVAL
+
+			self.__last_sweep = None
+			self.__reaper_runs = 0
+			self.__reaper_lag = 0.0
+			self.__reclaimed_last_run = 0
+			self.__reclaimed_total = 0
+
+			self.__reap_event = Event()
+			self.__reaper_thread = thread.EasyThread(self.__reap_loop, True)
+			self.__reaper_thread.start()
+
 		if cls.__instance.__dead:
 			dead = type("Dead SessionManager", (object,), {})
-			dead.sessions = dead.lock = dead.folder_path = dead.__dead = None
-			dead.get_session = dead.make_session = dead.is_session_authenticated = dead.shutdown = lambda *args, **kwargs: None
+			dead.store = cls.__instance.store # Still saves sessions that are marked dirty
+			dead.sessions = dead.lock = dead.folder_path = dead.dirty = dead.flushing = dead.pinned = dead.__dead = None
+			dead.cache_size = dead.cache_bytes = None
+			dead.flush_interval = dead.flush_threshold = dead.max_unflushed_age = dead.expiry = None
+			dead.reap_interval = dead.reap_batch_size = dead.sweep_interval = None
+			dead.metrics = {}
+			dead.get_session = dead.make_session = dead.is_session_authenticated = dead.flush = dead.shutdown = lambda *args, **kwargs: None
+			dead.destroy_many = dead.pin = dead.unpin = lambda *args, **kwargs: None
+			dead.reap = lambda *args, **kwargs: 0
+			dead.mark_dirty = lambda session, hot_only = True, *args, **kwargs: session.save(hot_only) # Nothing left to flush it later
 			return dead
 
 		return cls.__instance
 
 	def __init__(self):
 		# For typing
-		self.sessions: Dict[bytes, Session]
+		self.sessions: OrderedDict[bytes, Session] # Least recently used first
 		self.lock: RLock
 		self.folder_path: str
+		self.store: SessionStore
+
+		self.pinned: Dict[bytes, int] # Session id: how many connections are using it
+		self.cache_size: int
+		self.cache_bytes: int
+
+		self.dirty: Dict[bytes, Tuple[Session, float, bool]] # Session, when it was first marked and if only hot fields changed
+		self.flushing: Dict[bytes, Tuple[Session, float, bool]] # Dirty sessions being saved by flush
+		self.flush_interval: float
+		self.flush_threshold: int
+		self.max_unflushed_age: float
+
+		self.expiry: List[Tuple[int, bytes]] # Heap of expires, session id, entries not in __scheduled are stale
+		self.reap_interval: float
+		self.reap_batch_size: int
+		self.sweep_interval: float
 
 		self.__dead: bool
+		self.__scheduled: Dict[bytes, int] # Session id: expires of its one live entry in the expiry heap
+		self.__sizes: Dict[bytes, int]
+		self.__cached_bytes: int
+		self.__hits: int
+		self.__misses: int
+		self.__evictions: int
+
+		self.__flush_event: Event
+		self.__flush_thread: thread.EasyThread
+
+		self.__last_sweep: Union[float, None]
+		self.__reaper_runs: int
+		self.__reaper_lag: float
+		self.__reclaimed_last_run: int
+		self.__reclaimed_total: int
+		self.__reap_event: Event
+		self.__reaper_thread: thread.EasyThread
 
 		raise RuntimeError("Get session manager from SessionManager.get_manager()")
 
@@ -42,24 +174,37 @@ class SessionManager:
 			if not self.__dead:
 				if session_id in self.sessions:
 					if not self.sessions[session_id].destroyed:
+						self.sessions.move_to_end(session_id)
+						self.__hits += 1
 						return self.sessions[session_id]
 
-				filepath = self.folder_path + ",".join([str(byte) for byte in session_id]) + ".homesec"
-				if io_handles.FileUtil.does_file_exist(filepath):
-					return Session.session_from_file(io_handles.EasyFile(filepath))
+				self.__misses += 1
+
+				pending = self.dirty.get(session_id) or self.flushing.get(session_id)
+				if pending is not None: # Changed after it was evicted, or evicted while being saved
+					session = pending[0]
+
+					if not session.destroyed:
+						self.__cache(session)
+						return session
+
+				session_data = self.store.load(session_id)
+				if session_data is not None:
+					session = Session.from_data(session_id, session_data)
+					self.__cache(session)
+					return session
 
 	def make_session(self) -> "Session":
 		with self.lock:
 			if not self.__dead:
 				id = secrets.token_bytes(32)
 
-				while id in self.sessions:
+				while id in self.sessions or id in self.store:
 					id = secrets.token_bytes(32)
 
 				session = Session(int(datetime.now(timezone.utc).timestamp()) + 1800, id, 0, bytes([0]) * 32, bytes([0]) * 32, bytes([0]) * 32)
 				session.save()
-
-				self.sessions[id] = session
+				self.__cache(session)
 
 				return session
 
@@ -72,97 +217,821 @@ class SessionManager:
 
 		return False
 
+	@staticmethod
+	def size_of(session: "Session") -> int:
+		"""
+		Estimated bytes used by a session
+		"""
+		return SessionManager.SESSION_OVERHEAD + sum(len(value) for value in (session.id, session.past_random, session.present_random, \
+			session.future_random, session.shared_aes, session.server_rsa_public, session.server_rsa_private, \
+			session.client_rsa_public, session.client_rsa_private) if value is not None)
+
+	def __cache(self, session: "Session") -> None:
+		self.sessions[session.id] = session
+		self.sessions.move_to_end(session.id)
+		self.__resize(session)
+		self.__schedule(session)
+
+		self.__evict()
+
+	def __schedule(self, session: "Session") -> bool:
+		"""
+		Pushes a session onto the expiry heap unless its entry there is due
+		no later, the reaper pushes it again if it was extended. Returns if
+		it was pushed
+		"""
+		if self.__scheduled.get(session.id, session.expires + 1) <= session.expires:
+			return False
+
+		self.__scheduled[session.id] = session.expires # Any earlier entry is left in the heap as stale
+		heappush(self.expiry, (session.expires, session.id))
+		return True
+
+	def __resize(self, session: "Session") -> None:
+		size = SessionManager.size_of(session)
+		self.__cached_bytes += size - self.__sizes.get(session.id, 0)
+		self.__sizes[session.id] = size
+
+	def __uncache(self, session_id: bytes) -> Union["Session", None]:
+		self.__cached_bytes -= self.__sizes.pop(session_id, 0)
+		return self.sessions.pop(session_id, None)
+
+	def __evict(self) -> None:
+		"""
+		Evicts the least recently used sessions until both caps are met,
+		dirty sessions are saved first. Their held file and parsed keys
+		are let go too
+		"""
+		skipped = 0
+
+		while (len(self.sessions) > self.cache_size or self.__cached_bytes > self.cache_bytes) and skipped < len(self.sessions):
+			session_id = next(iter(self.sessions))
+
+			if session_id in self.pinned:
+				self.sessions.move_to_end(session_id) # In use, so recently used
+				skipped += 1
+				continue
+
+			session = self.__uncache(session_id)
+			self.__evictions += 1
+
+			if session_id in self.dirty:
+				session.save(self.dirty.pop(session_id)[2])
+
+			self.store.close_file(session_id)
+			encryption.RSAKeyCache.get_cache().evict(session_id)
+
+	def pin(self, session: "Session") -> None:
+		"""
+		Keeps a session cached until it's unpinned as many times
+		"""
+		with self.lock:
+			if self.__dead: return
+
+			self.pinned[session.id] = self.pinned.get(session.id, 0) + 1
+
+			if self.sessions.get(session.id) is not session and not session.destroyed:
+				self.__cache(session)
+
+	def unpin(self, session: "Session") -> None:
+		with self.lock:
+			if self.__dead or session.id not in self.pinned: return
+
+			self.pinned[session.id] -= 1
+
+			if self.pinned[session.id] <= 0:
+				del self.pinned[session.id]
+				self.__evict()
+
+	def mark_dirty(self, session: "Session", hot_only: bool = True) -> None:
+		"""
+		Queues a session to be saved by the flush thread instead of
+		saving it on the calling thread
+
+		hot_only should be False if anything other than the expires,
+		step or random fields has changed
+		"""
+		with self.lock:
+			if self.__dead:
+				session.save(hot_only)
+				return
+
+			if session.id not in self.dirty:
+				self.dirty[session.id] = (session, monotonic(), hot_only)
+			elif not hot_only:
+				self.dirty[session.id] = (session, self.dirty[session.id][1], False)
+
+			if self.sessions.get(session.id) is session:
+				if self.__schedule(session) and self.expiry[0][1] == session.id: # Expires was lowered to before the reaper's next run
+					self.__reap_event.set()
+
+				if not hot_only: # Keys may have changed size
+					self.__resize(session)
+					self.__evict()
+
+			if len(self.dirty) >= self.flush_threshold:
+				self.__flush_event.set()
+
+			if self.__flush_thread is None:
+				self.__flush_thread = thread.EasyThread(self.__flush_loop, True)
+				self.__flush_thread.start()
+
+	def flush(self) -> None:
+		"""
+		Saves every dirty session now, if saving fails the sessions are
+		dirty again so the next flush retries them
+		"""
+		with self.lock:
+			if not len(self.dirty): return
+
+			dirty = self.flushing = self.dirty
+			self.dirty = {}
+
+		try:
+			self.store.save_many([(session, hot_only) for session, _, hot_only in dirty.values() if not session.destroyed])
+		except BaseException:
+			with self.lock:
+				restored = {}
+
+				for session_id, (session, marked, hot_only) in dirty.items(): # Marked before anything dirtied since, so they go first
+					if not session.destroyed:
+						restored[session_id] = (session, marked, hot_only and self.dirty.get(session_id, (None, None, True))[2])
+
+				for session_id, entry in self.dirty.items():
+					restored.setdefault(session_id, entry)
+
+				self.dirty = restored
+
+			raise
+		finally:
+			with self.lock:
+				self.flushing = {}
+
+		with self.lock:
+			for session_id in dirty:
+				if session_id not in self.sessions: # Evicted before it was flushed
+					self.store.close_file(session_id)
+
+	def __flush_loop(self) -> None:
+		with self.lock:
+			if len(self.dirty):
+				oldest = next(iter(self.dirty.values()))[1] # Dirty sessions are kept in the order they were marked
+				timeout = min(self.flush_interval, self.max_unflushed_age - (monotonic() - oldest))
+			else:
+				timeout = self.flush_interval
+
+		if timeout > 0:
+			self.__flush_event.wait(timeout)
+
+		self.__flush_event.clear()
+
+		try:
+			self.flush()
+		except Exception as e: # Keeps the flush thread alive, the sessions are retried next time
+			failure.notice(failure.Threading.Exception_Raised, f"Failed to save {len(self.dirty)} dirty sessions", True, e)
+
+	def destroy_many(self, sessions: List["Session"]) -> None:
+		"""
+		Destroys a batch of sessions, deleting them from the store together
+		"""
+		with self.lock:
+			destroyed = []
+
+			for session in sessions:
+				with session.internal_lock:
+					if session.destroyed:
+						continue
+
+					session.destroyed = True
+
+				destroyed.append(session.id)
+				self.__uncache(session.id)
+				self.__scheduled.pop(session.id, None)
+				self.dirty.pop(session.id, None)
+				encryption.RSAKeyCache.get_cache().evict(session.id)
+
+			self.store.delete_many(destroyed)
+
+	def reap(self) -> int:
+		"""
+		Destroys every expired session, returns how many were reclaimed
+		"""
+		now = datetime.now(timezone.utc).timestamp()
+		reclaimed = 0
+		lag = 0.0
+
+		while True: # Lock is let go between batches so packets aren't held up
+			with self.lock:
+				if self.__dead: return reclaimed
+
+				batch = []
+
+				while len(self.expiry) and self.expiry[0][0] <= now and len(batch) < self.reap_batch_size:
+					expires, session_id = heappop(self.expiry)
+
+					if self.__scheduled.get(session_id) != expires: # Stale, rescheduled earlier or destroyed
+						continue
+
+					del self.__scheduled[session_id]
+					session = self.sessions.get(session_id)
+
+					if session is None or session.destroyed: # Destroyed some other way or evicted, the store sweep gets evicted ones
+						continue
+
+					if session.expires > expires: # Extended since it was pushed
+						self.__schedule(session)
+						continue
+
+					batch.append(session)
+					lag = max(lag, now - expires)
+
+				if not len(batch):
+					break
+
+				self.destroy_many(batch)
+				reclaimed += len(batch)
+
+		if self.__last_sweep is None or monotonic() - self.__last_sweep >= self.sweep_interval:
+			expired = self.store.expiring_before(int(now) + 1)
+
+			for start in range(0, len(expired), self.reap_batch_size):
+				with self.lock:
+					if self.__dead: return reclaimed
+
+					batch = [session_id for session_id in expired[start:start + self.reap_batch_size] if session_id not in self.sessions] # Loaded ones are in the heap
+					self.store.delete_many(batch)
+
+					for session_id in batch:
+						encryption.RSAKeyCache.get_cache().evict(session_id)
+
+					reclaimed += len(batch)
+
+			self.__last_sweep = monotonic() # Only once it worked, so a failed sweep is retried next run
+
+		with self.lock:
+			self.__reaper_runs += 1
+			self.__reaper_lag = lag
+			self.__reclaimed_last_run = reclaimed
+			self.__reclaimed_total += reclaimed
+
+		return reclaimed
+
+	def __reap_loop(self) -> None:
+		with self.lock:
+			timeout = 0 if self.__last_sweep is None else self.reap_interval # Sweep the store straight away on startup
+
+			if len(self.expiry):
+				timeout = min(timeout, self.expiry[0][0] - datetime.now(timezone.utc).timestamp())
+
+		if timeout > 0:
+			self.__reap_event.wait(timeout)
+
+		self.__reap_event.clear()
+
+		try:
+			self.reap()
+		except Exception as e: # Keeps the reaper alive, the next run tries again
+			failure.notice(failure.Threading.Exception_Raised, "Failed to reap expired sessions", True, e)
+			self.__reap_event.wait(self.reap_interval) # A sweep that hasn't worked yet would otherwise be retried straight away
+
+	@property
+	def metrics(self) -> Dict[str, Union[int, float]]:
+		"""
+		Session cache size, hits, misses and evictions, sessions waiting to
+		expire, how late the last reaper run was in seconds and how many
+		sessions it has reclaimed
+		"""
+		with self.lock:
+			return {
+				"cached": len(self.sessions),
+				"cached_bytes": self.__cached_bytes,
+				"cache_hits": self.__hits,
+				"cache_misses": self.__misses,
+				"cache_evictions": self.__evictions,
+				"pinned": len(self.pinned),
+				"tracked": len(self.__scheduled),
+				"reaper_runs": self.__reaper_runs,
+				"reaper_lag": self.__reaper_lag,
+				"reclaimed_last_run": self.__reclaimed_last_run,
+				"reclaimed_total": self.__reclaimed_total
+			}
+
 	def shutdown(self) -> None:
 		with self.lock:
 			if not self.__dead:
 				self.__dead = True
 
-				for session in self.sessions.values():
-					if not session.destroyed:
-						session.save()
+				if self.__flush_thread is not None:
+					self.__flush_thread.kill()
+
+				self.__reaper_thread.kill()
+
+				self.flush()
 
-				self.sessions = {}
+				self.store.close()
+				self.sessions = OrderedDict()
+				self.expiry = []
+				self.__scheduled = {}
+				self.pinned = {}
+				self.__sizes = {}
+				self.__cached_bytes = 0
+				encryption.RSAKeyCache.get_cache().clear()
 
-class Session(NamedTuple):
-	expires: int # 4 bytes
-	id: bytes # 32 bytes
-	step: int # 2 bytes
-	past_random: bytes # 32 bytes, prior random we generated
-	present_random: bytes # 32 bytes, random recieved from other party, they expect it in the next packet
-	future_random: bytes # 32 bytes, next expected random we generated
+class SessionStore:
+	"""
+	Where sessions are saved
 
-	shared_aes: bytes = None # 32 bytes
-	server_rsa_public: bytes = None
-	server_rsa_private: bytes = None
-	client_rsa_public: bytes = None
-	client_rsa_private: bytes = None
+	bulk_load is True if load_all is cheap enough to use on startup
+	"""
 
-	internal_lock = RLock()
-	internal_file: "io_handles.EasyFile" = None
-	destroyed: bool = False
+	BACKENDS = ("file", "sqlite")
+	DEFAULT_BACKEND = "file"
+
+	bulk_load = False
 
 	@staticmethod
-	def session_from_file(file: "io_handles.EasyFile") -> Union["Session", None]:
-		mngr = SessionManager.get_manager()
+	def from_config(folder_path: str) -> "SessionStore":
+		"""
+		Opens the store named by "session_backend" in the config
+		"""
+		backend = installer.get_config_value("session_backend", SessionStore.DEFAULT_BACKEND)
 
-		file_name_splits = file.name.split(",")
-		if len(file_name_splits) != 32:
-			return None
+		if backend == "sqlite":
+			return SQLiteSessionStore(folder_path.rstrip("/") + ".homesec")
 
-		id_bytes = []
+		return FileSessionStore(folder_path)
 
-		for id_part in file_name_splits:
-			if id_part.isdigit():
-				id_bytes.append(int(id_part))
-			else:
-				return None
+	def __contains__(self, session_id: bytes) -> bool:
+		raise NotImplementedError()
 
-		id = bytes(id_bytes)
-		del file_name_splits, id_bytes
+	def load(self, session_id: bytes) -> Union["io_handles.SessionFileData", None]:
+		raise NotImplementedError()
 
-		with mngr.lock:
-			if id in mngr.sessions:
-				return mngr.sessions[id]
+	def load_all(self, expires_after: int = None, limit: int = None) -> Dict[bytes, "io_handles.SessionFileData"]:
+		"""
+		Loads every session, or only those that expire after expires_after.
+		With a limit only the limit sessions that expire last are loaded,
+		longest lived first
+		"""
+		raise NotImplementedError()
 
-			session_data = io_handles.SessionFileFormat().from_file(file)
+	def save(self, session: "Session", hot_only: bool = False, hold: bool = False) -> None:
+		"""
+		Saves a session, if hot_only is True only the expires, step and
+		random fields have changed. hold is a hint the session will be
+		saved again soon
+		"""
+		raise NotImplementedError()
 
-			session = Session(session_data.expires, id, session_data.step, session_data.past_random, \
-				session_data.present_random, session_data.future_random, session_data.shared_aes, session_data.server_rsa_public, \
-				session_data.server_rsa_private, session_data.client_rsa_public, session_data.client_rsa_private, file)
+	def save_many(self, sessions: List[Tuple["Session", bool]]) -> None:
+		"""
+		Saves a batch of (session, hot_only) together
+		"""
+		raise NotImplementedError()
 
-			mngr.sessions[id] = session
-			return session
+	def delete(self, session_id: bytes) -> None:
+		raise NotImplementedError()
 
-	def save(self):
-		with self.__internal_lock:
-			if self.destroyed:
+	def delete_many(self, session_ids: List[bytes]) -> None:
+		for session_id in session_ids:
+			self.delete(session_id)
+
+	def expiring_before(self, epoch: int) -> List[bytes]:
+		"""
+		Ids of the sessions that expire before epoch
+		"""
+		raise NotImplementedError()
+
+	def close_file(self, session_id: bytes) -> None:
+		"""
+		Lets go of anything kept open for a session, nothing by default
+		"""
+		pass
+
+	def close(self) -> None:
+		raise NotImplementedError()
+
+class FileSessionStore(SessionStore):
+	"""
+	Keeps every session in its own file named by its hex id, sharded
+	into folders by the first byte: <folder>/<2 hex digits>/<64 hex digits>.homesec
+
+	Every session file is indexed when the store is made so lookups never
+	touch the disk. Session files from before sharding, named by the id's
+	bytes joined with commas, are moved into their shard while indexing
+
+	Files of sessions whose hot fields are saved with hold are kept open
+	so the next in place update doesn't reopen them, at most MAX_HELD
+	files are held and the least recently saved is closed first
+	"""
+
+	HEX_NAME = re.compile(r"[0-9a-f]{64}\.homesec")
+	MAX_HELD = 64
+
+	def __init__(self, folder_path: str):
+		self.folder_path = folder_path
+		self.lock = RLock()
+		self.index: Dict[bytes, str] = {} # Session id: file path
+		self.files: OrderedDict[bytes, io_handles.EasyFile] = OrderedDict() # Held files, least recently saved first
+		self.migrated = 0 # Old layout files moved by the last build_index
+
+		self.build_index()
+
+	def __contains__(self, session_id: bytes) -> bool:
+		return session_id in self.index
+
+	def path_for(self, session_id: bytes) -> str:
+		hex_id = session_id.hex()
+		return f"{self.folder_path}{hex_id[:2]}/{hex_id}.homesec"
+
+	def build_index(self) -> None:
+		"""
+		Indexes every session file, migrating any in the old layout
+		"""
+		with self.lock:
+			self.index = {}
+			self.migrated = self.migrate()
+
+			if not io_handles.FileUtil.does_folder_exist(self.folder_path):
 				return
 
-			if self.internal_file is None:
-				self.internal_file = io_handles.EasyFile(self.filepath)
+			for shard in scandir(self.folder_path):
+				if shard.is_dir() and len(shard.name) == 2:
+					for entry in scandir(shard.path):
+						if FileSessionStore.HEX_NAME.fullmatch(entry.name):
+							self.index[bytes.fromhex(entry.name[:64])] = entry.path
 
-			io_handles.SessionFileFormat().save_to(self.internal_file, io_handles.SessionFileData(self.expires, self.step, \
-				self.past_random, self.present_random, self.future_random, self.shared_aes, self.server_rsa_public, \
-				self.server_rsa_private, self.client_rsa_public, self.client_rsa_private))
+	def migrate(self) -> int:
+		"""
+		Moves session files named by comma joined id bytes into their
+		shard, returns how many were moved
+		"""
+		if not io_handles.FileUtil.does_folder_exist(self.folder_path):
+			return 0
 
-	def destroy(self):
-		with self.__internal_lock:
-			if not self.destroyed:
-				self.destroyed = True
+		moved = 0
+
+		with self.lock:
+			for entry in scandir(self.folder_path):
+				if not entry.is_file() or not entry.name.endswith(".homesec"):
+					continue
+
+				parts = entry.name[:-len(".homesec")].split(",")
+				if len(parts) != 32 or not all(part.isdigit() and int(part) < 256 for part in parts):
+					continue
+
+				session_id = bytes(int(part) for part in parts)
+				path = self.path_for(session_id)
+
+				makedirs(path.rsplit("/", 1)[0], 0o700, exist_ok = True)
+				replace(entry.path, path)
+				self.index[session_id] = path
+				moved += 1
+
+			if moved:
+				io_handles.FileUtil.sync_directory(self.folder_path)
+
+		return moved
+
+	def file_for(self, session_id: bytes, hold: bool = False) -> "io_handles.EasyFile":
+		"""
+		Gets a session's file, creating it if needed. If hold is True the
+		file is kept open until it's one of the least recently saved
+		"""
+		with self.lock:
+			file = self.files.get(session_id)
+
+			if file is not None:
+				self.files.move_to_end(session_id)
+				return file
+
+			file = io_handles.EasyFile(self.path_for(session_id), True, atomic = True)
+			self.index[session_id] = file.filepath
+
+			if hold:
+				file.hold()
+				self.files[session_id] = file
+
+				while len(self.files) > FileSessionStore.MAX_HELD:
+					self.files.popitem(last = False)[1].close() # Waits for any save using it
+
+			return file
+
+	def close_file(self, session_id: bytes) -> None:
+		"""
+		Closes a session's file if it's held
+		"""
+		with self.lock:
+			file = self.files.pop(session_id, None)
+
+			if file is not None:
+				file.close()
+
+	def load(self, session_id: bytes) -> Union["io_handles.SessionFileData", None]:
+		if session_id not in self.index:
+			return None
+
+		file = self.file_for(session_id)
+		session_data = io_handles.SessionFileFormatV2().from_file(file)
+
+		if session_data.version != 2:
+			io_handles.SessionFileFormatV2().save_to(file, session_data) # Migrate so hot fields can be updated in place
+
+		return session_data
+
+	def save(self, session: "Session", hot_only: bool = False, hold: bool = False) -> None:
+		with session.internal_lock: # Destroying waits for the save, so a destroyed session's file isn't made again
+			if session.destroyed:
+				return
+
+			file = self.file_for(session.id, hold and hot_only) # Full saves replace the file, so a held handle wouldn't be reused
+			session_format = io_handles.SessionFileFormatV2()
+			session_data = session.to_data()
+
+			if hot_only and session_format.update_hot(file, session_data):
+				return
+
+			session_format.save_to(file, session_data)
+
+	def save_many(self, sessions: List[Tuple["Session", bool]]) -> None:
+		with io_handles.CommitGroup(): # One sync per shard for the whole batch
+			for session, hot_only in sessions:
+				self.save(session, hot_only, True)
+
+	def load_all(self, expires_after: int = None, limit: int = None) -> Dict[bytes, "io_handles.SessionFileData"]:
+		loaded = {}
+
+		for session_id in list(self.index):
+			session_data = self.load(session_id)
 
-				if io_handles.FileUtil.does_file_exist(self.filepath):
-					io_handles.FileUtil.delete_file(self.filepath)
+			if session_data is not None and (expires_after is None or session_data.expires > expires_after):
+				loaded[session_id] = session_data
 
-				mngr = SessionManager.get_manager()
+		if limit is None:
+			return loaded
+
+		return dict(sorted(loaded.items(), key = lambda item: item[1].expires, reverse = True)[:limit])
+
+	def expiring_before(self, epoch: int) -> List[bytes]:
+		"""
+		Only the expires field of each file is read, files that can't be
+		read are skipped
+		"""
+		session_format = io_handles.SessionFileFormatV2()
+		expiring = []
+
+		with self.lock:
+			index = list(self.index.items())
+
+		for session_id, path in index:
+			try:
+				if session_format.read_expires(io_handles.EasyFile(path)) < epoch:
+					expiring.append(session_id)
+			except (io_handles.FileDecodeError, OSError): # Corrupt or deleted since, load reports corrupt files
+				continue
+
+		return expiring
+
+	def delete(self, session_id: bytes) -> None:
+		with self.lock:
+			self.close_file(session_id)
 
-				with mngr.lock:
-					del mngr.sessions[self.id]
+			path = self.index.pop(session_id, None)
+			if path is not None:
+				io_handles.FileUtil.delete_file(path)
+
+	def close(self) -> None:
+		"""
+		Closes every held session file
+		"""
+		with self.lock:
+			for file in self.files.values():
+				file.close()
+
+			self.files = OrderedDict()
+
+class SQLiteSessionStore(SessionStore):
+	"""
+	Keeps every session as a row of one SQLite database in WAL mode
+
+	Batches are upserted in a single transaction and sessions are
+	indexed by when they expire. The connection is reopened if it's used
+	after close
+	"""
+
+	bulk_load = True
+
+	COLUMNS = ("id", "expires", "step", "past_random", "present_random", "future_random", "shared_aes", \
+		"server_rsa_public", "server_rsa_private", "client_rsa_public", "client_rsa_private")
+
+	def __init__(self, database_path: str):
+		self.database_path = database_path
+		self.lock = RLock()
+		self.__connection: sqlite3.Connection = None
 
 	@property
-	def filepath(self) -> str:
-		return io_handles.FileUtil.root() + "/data/sessions/" + ",".join([str(byte) for byte in self.id]) + ".homesec"
+	def connection(self) -> sqlite3.Connection:
+		with self.lock:
+			if self.__connection is None:
+				makedirs(self.database_path.rsplit("/", 1)[0], 0o700, exist_ok = True)
+
+				connection = sqlite3.connect(self.database_path, check_same_thread = False) # Only used while holding the lock
+				connection.execute("PRAGMA journal_mode = WAL")
+				connection.execute("PRAGMA synchronous = NORMAL") # WAL commits stay atomic, only the last few can be lost on power loss
+				connection.execute("""CREATE TABLE IF NOT EXISTS sessions (
+					id BLOB PRIMARY KEY, expires INTEGER NOT NULL, step INTEGER NOT NULL,
+					past_random BLOB NOT NULL, present_random BLOB NOT NULL, future_random BLOB NOT NULL,
+					shared_aes BLOB, server_rsa_public BLOB, server_rsa_private BLOB, client_rsa_public BLOB, client_rsa_private BLOB
+				) WITHOUT ROWID""")
+				connection.execute("CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires)")
+				connection.commit()
+
+				self.__connection = connection
+
+			return self.__connection
+
+	@staticmethod
+	def __to_data(row: Tuple) -> "io_handles.SessionFileData":
+		return io_handles.SessionFileData(*row[1:], version = 2)
+
+	@staticmethod
+	def __to_row(session_id: bytes, session_data: "io_handles.SessionFileData") -> Tuple:
+		return (session_id, session_data.expires, session_data.step, session_data.past_random, session_data.present_random, \
+			session_data.future_random, session_data.shared_aes, session_data.server_rsa_public, session_data.server_rsa_private, \
+			session_data.client_rsa_public, session_data.client_rsa_private)
+
+	def __contains__(self, session_id: bytes) -> bool:
+		with self.lock:
+			return self.connection.execute("SELECT 1 FROM sessions WHERE id = ?", (session_id,)).fetchone() is not None
+
+	def load(self, session_id: bytes) -> Union["io_handles.SessionFileData", None]:
+		with self.lock:
+			row = self.connection.execute(f"SELECT {', '.join(SQLiteSessionStore.COLUMNS)} FROM sessions WHERE id = ?", (session_id,)).fetchone()
+
+		return None if row is None else SQLiteSessionStore.__to_data(row)
+
+	def load_all(self, expires_after: int = None, limit: int = None) -> Dict[bytes, "io_handles.SessionFileData"]:
+		query = f"SELECT {', '.join(SQLiteSessionStore.COLUMNS)} FROM sessions"
+		parameters = ()
+
+		if expires_after is not None:
+			query += " WHERE expires > ?"
+			parameters += (expires_after,)
+
+		if limit is not None:
+			query += " ORDER BY expires DESC LIMIT ?"
+			parameters += (limit,)
+
+		with self.lock:
+			rows = self.connection.execute(query, parameters).fetchall()
+
+		return {row[0]: SQLiteSessionStore.__to_data(row) for row in rows}
+
+	def save(self, session: "Session", hot_only: bool = False, hold: bool = False) -> None:
+		self.save_many([(session, hot_only)])
+
+	def save_many(self, sessions: List[Tuple["Session", bool]]) -> None:
+		if not len(sessions): return
+
+		copied = [(session, session.to_data(), hot_only) for session, hot_only in sessions] # Copied before taking the lock
+
+		with self.lock:
+			# Sessions destroyed from here on are deleted after this transaction
+			sessions = [(session.id, session_data, hot_only) for session, session_data, hot_only in copied if not session.destroyed]
+
+			hot = [(session_data.expires, session_data.step, session_data.past_random, session_data.present_random, session_data.future_random, session_id) \
+				for session_id, session_data, hot_only in sessions if hot_only]
+			full = [SQLiteSessionStore.__to_row(session_id, session_data) for session_id, session_data, hot_only in sessions if not hot_only]
+
+			with self.connection: # One transaction, committed on exit
+				if len(hot):
+					cursor = self.connection.executemany("UPDATE sessions SET expires = ?, step = ?, past_random = ?, present_random = ?, future_random = ? WHERE id = ?", hot)
+
+					if cursor.rowcount != len(hot): # Sessions that were never fully saved need a whole row
+						full += [SQLiteSessionStore.__to_row(session_id, session_data) for session_id, session_data, hot_only in sessions if hot_only and session_id not in self]
+
+				if len(full):
+					self.connection.executemany(f"INSERT OR REPLACE INTO sessions ({', '.join(SQLiteSessionStore.COLUMNS)}) VALUES ({', '.join('?' * len(SQLiteSessionStore.COLUMNS))})", full)
+
+	def delete(self, session_id: bytes) -> None:
+		with self.lock:
+			with self.connection:
+				self.connection.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+	def delete_many(self, session_ids: List[bytes]) -> None:
+		if not len(session_ids): return
+
+		with self.lock:
+			with self.connection: # One transaction, committed on exit
+				self.connection.executemany("DELETE FROM sessions WHERE id = ?", [(session_id,) for session_id in session_ids])
+
+	def expiring_before(self, epoch: int) -> List[bytes]:
+		with self.lock:
+			return [row[0] for row in self.connection.execute("SELECT id FROM sessions WHERE expires < ? ORDER BY expires", (epoch,))]
+
+	def close(self) -> None:
+		with self.lock:
+			if self.__connection is not None:
+				self.__connection.close()
+				self.__connection = None
+
+class Session:
+	"""
+	A session with another device
+
+	The past, present and future randoms live in fixed size bytearrays
+	that are updated in place, assigning one copies into its buffer.
+	Hold internal_lock while changing or reading fields that belong together
+	"""
+
+	RANDOM_SIZE = 32
+
+	__slots__ = ("expires", "id", "step", "__past_random", "__present_random", "__future_random", "shared_aes", \
+		"server_rsa_public", "server_rsa_private", "client_rsa_public", "client_rsa_private", "destroyed", "internal_lock")
+
+	def __init__(self, expires: int, id: bytes, step: int, past_random: bytes, present_random: bytes, future_random: bytes, \
+		shared_aes: bytes = None, server_rsa_public: bytes = None, server_rsa_private: bytes = None, \
+		client_rsa_public: bytes = None, client_rsa_private: bytes = None):
+
+		self.expires = expires # 4 bytes
+		self.id = id # 32 bytes
+		self.step = step # 2 bytes
+		self.__past_random = bytearray(Session.RANDOM_SIZE) # Prior random we generated
+		self.__present_random = bytearray(Session.RANDOM_SIZE) # Random recieved from other party, they expect it in the next packet
+		self.__future_random = bytearray(Session.RANDOM_SIZE) # Next expected random we generated
+
+		self.past_random = past_random
+		self.present_random = present_random
+		self.future_random = future_random
+
+		self.shared_aes = shared_aes # 32 bytes
+		self.server_rsa_public = server_rsa_public
+		self.server_rsa_private = server_rsa_private
+		self.client_rsa_public = client_rsa_public
+		self.client_rsa_private = client_rsa_private
+
+		self.destroyed = False
+		self.internal_lock = RLock()
+
+	@staticmethod
+	def __set_random(buffer: bytearray, value: bytes) -> None:
+		if len(value) != Session.RANDOM_SIZE:
+			raise ValueError(f"Randoms must be {Session.RANDOM_SIZE} bytes")
+
+		buffer[:] = value # Same length, so no reallocation
+
+	@property
+	def past_random(self) -> bytearray: return self.__past_random
+
+	@past_random.setter
+	def past_random(self, value: bytes): Session.__set_random(self.__past_random, value)
+
+	@property
+	def present_random(self) -> bytearray: return self.__present_random
+
+	@present_random.setter
+	def present_random(self, value: bytes): Session.__set_random(self.__present_random, value)
+
+	@property
+	def future_random(self) -> bytearray: return self.__future_random
+
+	@future_random.setter
+	def future_random(self, value: bytes): Session.__set_random(self.__future_random, value)
+
+	@staticmethod
+	def from_data(id: bytes, session_data: "io_handles.SessionFileData") -> "Session":
+		return Session(session_data.expires, id, session_data.step, session_data.past_random, \
+			session_data.present_random, session_data.future_random, session_data.shared_aes, session_data.server_rsa_public, \
+			session_data.server_rsa_private, session_data.client_rsa_public, session_data.client_rsa_private)
+
+	def to_data(self) -> "io_handles.SessionFileData":
+		"""
+		Copies the session's fields so they can be saved while it keeps changing
+		"""
+		with self.internal_lock:
+			return io_handles.SessionFileData(self.expires, self.step, bytes(self.__past_random), bytes(self.__present_random), \
+				bytes(self.__future_random), self.shared_aes, self.server_rsa_public, self.server_rsa_private, \
+				self.client_rsa_public, self.client_rsa_private, version = 2)
+
+	def save(self, hot_only: bool = False, hold: bool = False):
+		"""
+		Saves the session, if hot_only is True and the file is already
+		in the v2 layout only the expires, step and random fields are
+		written in place. hold keeps the file open for the next save
+		"""
+		with self.internal_lock:
+			if self.destroyed:
+				return
+
+			SessionManager.get_manager().store.save(self, hot_only, hold)
+
+	def mark_dirty(self, hot_only: bool = True):
+		SessionManager.get_manager().mark_dirty(self, hot_only)
+
+	def destroy(self):
+		SessionManager.get_manager().destroy_many([self])
 
 	@property
-	def has_expired(self) -> bool: int(datetime.now(timezone.utc).timestamp()) >= self.expires
+	def has_expired(self) -> bool: return int(datetime.now(timezone.utc).timestamp()) >= self.expires
 
-import io_handles
\ No newline at end of file
+import io_handles, encryption, thread, installer, failure
\ No newline at end of file
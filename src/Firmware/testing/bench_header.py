@@ -0,0 +1,96 @@
+"""
+Benchmarks building and reading packet headers with networking.codec
+against the original base 256 loops, checking both give the same bytes
+
+Run from the Firmware folder with `python3 testing/bench_header.py`
+"""
+
+import os, sys, timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking import codec
+
+VERSION = bytes([0, 0, 1])
+
+def legacy_from_base256(data: bytes) -> int:
+	value = len(data) - 1
+	total = 0
+
+	for index in range(value, -1, -1):
+		total += 256 ** (value - index) * data[index]
+
+	return total
+
+def legacy_to_base256(value: int) -> bytes:
+	values = []
+
+	while value > 0:
+		values.insert(0, value % 256)
+		value //= 256
+
+	return bytes(values)
+
+def legacy_length_data(length: int, width: int) -> bytes:
+	length_bytes = legacy_to_base256(length)
+	return (b"\00" * (width - len(length_bytes))) + length_bytes
+
+def legacy_add_length_data(data: bytes, width: int) -> bytes:
+	return legacy_length_data(len(data), width) + data
+
+def legacy_unencrypted(payload: bytes, protocol_id: int) -> bytes:
+	packet = VERSION + legacy_to_base256(protocol_id) + legacy_add_length_data(payload, 2)
+	return bytes([0]) + legacy_add_length_data(packet, 3)
+
+def codec_unencrypted(payload: bytes, protocol_id: int) -> bytes:
+	header = codec.UNENCRYPTED_HEADER.pack(VERSION, protocol_id, len(payload))
+	return codec.encode_flag_length(0, len(header) + len(payload)) + header + payload
+
+def legacy_encrypted(payload: bytes, protocol_id: int, step: int, fields: bytes) -> bytes:
+	packet = VERSION + legacy_add_length_data(legacy_to_base256(protocol_id), 1)
+	packet += bytes([(step + 1) // 256 % 256, (step + 1) % 256])
+	packet += fields
+	packet += legacy_add_length_data(payload, 2)
+	return bytes([1]) + legacy_length_data(len(packet) + 512, 3) + packet
+
+def codec_encrypted(payload: bytes, protocol_id: int, step: int, fields: bytes) -> bytes:
+	header = codec.ENCRYPTED_HEADER.pack(VERSION, 2, protocol_id, (step + 1) % 65536, fields[:32], fields[32:48], \
+		fields[48:64], fields[64:96], fields[96:128], len(payload))
+	return codec.encode_flag_length(1, len(header) + len(payload) + 512) + header + payload
+
+def legacy_read(packet: bytes) -> tuple:
+	return legacy_from_base256(packet[1:4]), legacy_from_base256(packet[8:10]), legacy_from_base256(packet[10:12])
+
+def codec_read(packet: bytes) -> tuple:
+	return codec.decode_flag_length(packet)[1], codec.UINT16.unpack_from(packet, 8)[0], codec.UINT16.unpack_from(packet, 10)[0]
+
+def bench(name: str, legacy, current, number: int = 200000) -> None:
+	legacy_time = timeit.timeit(legacy, number = number) / number * 1e6
+	current_time = timeit.timeit(current, number = number) / number * 1e6
+	print(f"{name:<24} legacy {legacy_time:7.3f} us, codec {current_time:7.3f} us ({legacy_time / current_time:.2f}x)")
+
+def main():
+	fields = os.urandom(128)
+	payload = os.urandom(64)
+
+	for protocol_id in range(1, 256):
+		assert legacy_unencrypted(payload, protocol_id) == codec_unencrypted(payload, protocol_id)
+
+	for protocol_id in (256, 272, 273, 65535):
+		for step in (0, 255, 256, 65534, 65535):
+			packet = codec_encrypted(payload, protocol_id, step, fields)
+			assert legacy_encrypted(payload, protocol_id, step, fields) == packet
+			assert legacy_read(packet) == codec_read(packet)
+
+	for value in (0, 1, 255, 256, 1800, 2 ** 31, 2 ** 64 + 3):
+		assert legacy_to_base256(value) == codec.encode_uint(value)
+		assert legacy_from_base256(legacy_to_base256(value)) == codec.decode_uint(codec.encode_uint(value))
+
+	packet = codec_encrypted(payload, 272, 300, fields)
+	bench("unencrypted header", lambda: legacy_unencrypted(payload, 16), lambda: codec_unencrypted(payload, 16))
+	bench("encrypted header", lambda: legacy_encrypted(payload, 272, 300, fields), lambda: codec_encrypted(payload, 272, 300, fields))
+	bench("header fields read", lambda: legacy_read(packet), lambda: codec_read(packet))
+	bench("session expires field", lambda: legacy_to_base256(1700000000), lambda: codec.encode_uint(1700000000))
+
+if __name__ == "__main__":
+	main()
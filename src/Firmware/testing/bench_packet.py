@@ -0,0 +1,213 @@
+"""
+Benchmarks networking.packet.dissect_packet against the original
+implementation that re-sliced the packet after every field
+
+Run from the Firmware folder with `python3 testing/bench_packet.py`
+"""
+
+import os, sys, timeit
+from typing import Callable, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking import packet
+from networking.packet import PacketStructure
+
+# Verbatim copies of the original decoder and its helpers
+
+def from_base256(data: bytes) -> int:
+	value = len(data) - 1
+	total = 0
+
+	for index in range(value, -1, -1):
+		total += 256 ** (value - index) * data[index]
+
+	return total
+
+def to_base256(value: int) -> bytes:
+	values = []
+
+	while value > 0:
+		values.insert(0, value % 256)
+		value //= 256
+
+	return bytes(values)
+
+def get_length_data(length: int, min_length: int = None, max_length: int = None) -> bytes:
+	length_bytes = to_base256(length)
+
+	if max_length is not None and max_length > 0 and min_length is not None and min_length > 0 and min_length > max_length:
+		raise ValueError(f"Minimum length is greater than maximum length, ({min_length} > {max_length})")
+
+	if min_length is not None and min_length > 0:
+		if len(length_bytes) < min_length:
+			length_bytes = (b"\00" * (min_length - len(length_bytes))) + length_bytes
+
+	if max_length is not None and max_length > 0:
+		if len(length_bytes) > max_length:
+			raise ValueError(f"Data is too long such that it's length cannot be saved in only {max_length} bytes, it needs at least {len(length_bytes)} bytes")
+
+	return length_bytes
+
+def add_length_data(data: bytes, min_length: int = None, max_length: int = None) -> bytes:
+	return get_length_data(len(data), min_length, max_length) + data
+
+def legacy_dissect_packet(packet: bytes) -> PacketStructure:
+	current_packet_length = len(packet)
+
+	if not current_packet_length:
+		raise ValueError("Empty packet")
+
+	is_encrypted = packet[0] == 1
+	packet = packet[1:]
+	current_packet_length -= 1
+
+	if current_packet_length < 3:
+		raise ValueError("Invalid End Of Packet")
+
+	packet_length = from_base256(packet[:3])
+	packet = packet[3:]
+	current_packet_length -= 3
+
+	if current_packet_length < 3:
+		raise ValueError("Invalid End Of Packet")
+
+	device_version = tuple(packet[:3])
+	packet = packet[3:]
+	current_packet_length -= 3
+
+	if current_packet_length < 2:
+		raise ValueError("Invalid End Of Packet")
+
+	if is_encrypted:
+		protocol_id_length = from_base256(packet[:1])
+		packet = packet[1:]
+		current_packet_length -= 1
+
+		if current_packet_length < protocol_id_length:
+			raise ValueError("Invalid End Of Packet")
+
+		protocol_id = from_base256(packet[:protocol_id_length])
+		packet = packet[protocol_id_length:]
+		current_packet_length -= protocol_id_length
+
+	else:
+		protocol_id = from_base256(packet[:1])
+		packet = packet[1:]
+		current_packet_length -= 1
+
+	if current_packet_length < 2:
+		raise ValueError("Invalid End Of Packet")
+
+	step = None
+	session_id = None
+	nonce = None
+	mac_tag = None
+	previous_random = None
+	next_random = None
+	signature = None
+
+	if is_encrypted:
+		if current_packet_length < 2:
+			raise ValueError("Invalid End Of Packet")
+
+		step = from_base256(packet[:2])
+		packet = packet[2:]
+		current_packet_length -= 2
+
+		if current_packet_length < 32:
+			raise ValueError("Invalid End Of Packet")
+
+		session_id = packet[:32]
+		packet = packet[32:]
+		current_packet_length -= 32
+
+		if current_packet_length < 16:
+			raise ValueError("Invalid End Of Packet")
+
+		nonce = packet[:16]
+		packet = packet[16:]
+		current_packet_length -= 16
+
+		if current_packet_length < 16:
+			raise ValueError("Invalid End Of Packet")
+
+		mac_tag = packet[:16]
+		packet = packet[16:]
+		current_packet_length -= 16
+
+		if current_packet_length < 32:
+			raise ValueError("Invalid End Of Packet")
+
+		previous_random = packet[:32]
+		packet = packet[32:]
+		current_packet_length -= 32
+
+		if current_packet_length < 32:
+			raise ValueError("Invalid End Of Packet")
+
+		next_random = packet[:32]
+		packet = packet[32:]
+		current_packet_length -= 32
+
+	if current_packet_length < 2:
+		raise ValueError("Invalid End Of Packet")
+
+	payload_length = from_base256(packet[:2])
+	packet = packet[2:]
+	current_packet_length -= 2
+
+	if current_packet_length < payload_length:
+		raise ValueError("Invalid End Of Packet")
+
+	payload = packet[:payload_length]
+	packet = packet[payload_length:]
+	current_packet_length -= payload_length
+
+	if is_encrypted:
+		if current_packet_length < 512:
+			raise ValueError("Invalid End Of Packet")
+
+		signature = packet[:512]
+		packet = packet[512:]
+		current_packet_length -= 512
+
+	if len(packet):
+		raise ValueError("Didn't reach End Of Packet")
+
+	return PacketStructure(is_encrypted, packet_length, device_version, protocol_id, payload, step, session_id, nonce, mac_tag, previous_random, next_random, signature)
+
+
+def make_unencrypted(payload: bytes) -> bytes:
+	body = bytes([0, 0, 1, 16]) + add_length_data(payload, 2, 2)
+	return bytes([0]) + add_length_data(body, 3, 3)
+
+def make_encrypted(payload: bytes) -> bytes:
+	body = bytes([0, 0, 1, 2, 1, 16, 0, 1]) + os.urandom(32 + 16 + 16 + 32 + 32) + add_length_data(payload, 2, 2)
+	return bytes([1]) + add_length_data(body + os.urandom(512), 3, 3)
+
+def bench(name: str, func: Callable[[bytes], PacketStructure], data: bytes, number: int) -> float:
+	seconds = timeit.timeit(lambda: func(data), number = number)
+	per_packet = seconds / number * 1e6
+	print(f"  {name:<24} {per_packet:10.2f} us/packet")
+	return per_packet
+
+def main():
+	cases: Tuple[Tuple[str, bytes, int], ...] = (
+		("unencrypted minimum", make_unencrypted(b""), 200000),
+		("unencrypted maximum", make_unencrypted(os.urandom(65535)), 2000),
+		("encrypted minimum", make_encrypted(b""), 200000),
+		("encrypted maximum", make_encrypted(os.urandom(65535)), 2000)
+	)
+
+	for name, data, number in cases:
+		assert legacy_dissect_packet(data)[:-1] == packet.dissect_packet(data)[:-1], f"Decoders disagree on {name}" # Legacy has no signature mode
+
+		print(f"{name} ({len(data)} bytes)")
+		legacy = bench("legacy (re-slicing)", legacy_dissect_packet, data, number)
+		current = bench("memoryview", packet.dissect_packet, data, number)
+		views = bench("memoryview, no copies", lambda data: packet.dissect_packet(data, False), data, number)
+		print(f"  speedup {legacy / current:.2f}x ({legacy / views:.2f}x without copies)")
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,85 @@
+"""
+Benchmarks the memory used by 10k live networking.sessions.Session
+records against the original NamedTuple, and the time taken to roll a
+session's step and randoms forward after each packet
+
+Run from the Firmware folder with `python3 testing/bench_sessions.py`
+"""
+
+import os, sys, timeit, tracemalloc
+from threading import RLock
+from typing import Callable, NamedTuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from networking.sessions import Session
+
+SESSIONS = 10000
+
+class LegacySession(NamedTuple):
+	expires: int
+	id: bytes
+	step: int
+	past_random: bytes
+	present_random: bytes
+	future_random: bytes
+
+	shared_aes: bytes = None
+	server_rsa_public: bytes = None
+	server_rsa_private: bytes = None
+	client_rsa_public: bytes = None
+	client_rsa_private: bytes = None
+
+	internal_lock = RLock()
+	destroyed: bool = False
+
+def make_fields(keys: bool) -> tuple:
+	fields = (1700000000, os.urandom(32), 0, os.urandom(32), os.urandom(32), os.urandom(32))
+
+	if keys: # AES key and 2048 bit RSA DER sized blobs
+		fields += (os.urandom(32), os.urandom(294), os.urandom(1192), os.urandom(294), os.urandom(1192))
+
+	return fields
+
+def measure(name: str, make: Callable[[tuple], object], keys: bool) -> float:
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	sessions = [make(make_fields(keys)) for _ in range(SESSIONS)] # Each session owns its fields, like ones loaded from the store
+	used = tracemalloc.get_traced_memory()[0] - before
+	tracemalloc.stop()
+
+	per_session = used / len(sessions)
+	print(f"  {name:<24} {used / 1024 / 1024:8.2f} MiB, {per_session:8.1f} bytes/session")
+	return per_session
+
+def legacy_roll(session: LegacySession, next_random: bytes) -> LegacySession:
+	return session._replace(step = (session.step + 1) % 65536, past_random = session.future_random, future_random = next_random)
+
+def roll(session: Session, next_random: bytes) -> Session:
+	with session.internal_lock:
+		session.step = (session.step + 1) % 65536
+		session.past_random = session.future_random
+		session.future_random = next_random
+
+	return session
+
+def main():
+	for keys in (False, True):
+		print(f"{SESSIONS} sessions {'with' if keys else 'without'} keys")
+		legacy = measure("NamedTuple", lambda session_fields: LegacySession(*session_fields), keys)
+		current = measure("Session", lambda session_fields: Session(*session_fields), keys)
+		print(f"  {'difference':<24} {current - legacy:+8.1f} bytes/session")
+
+	fields = make_fields(True)
+	next_random = os.urandom(32)
+	legacy_session, session = LegacySession(*fields), Session(*fields)
+
+	assert legacy_roll(legacy_session, next_random) == tuple(getattr(roll(Session(*fields), next_random), name) for name in LegacySession._fields)
+
+	number = 200000
+	legacy_time = timeit.timeit(lambda: legacy_roll(legacy_session, next_random), number = number) / number * 1e6
+	current_time = timeit.timeit(lambda: roll(session, next_random), number = number) / number * 1e6
+	print(f"step and random roll      NamedTuple {legacy_time:6.3f} us, Session {current_time:6.3f} us")
+
+if __name__ == "__main__":
+	main()